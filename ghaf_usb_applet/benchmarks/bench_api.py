@@ -0,0 +1,198 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# End-to-end APIClient benchmarks against the in-process mock vHotplug host:
+# request latency percentiles, attach throughput, batch moves,
+# notification fan-out for synthetic fleets, and how long the host is held
+# up pushing events to a subscriber with a slow handler.
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from common import report
+from ghaf_usb_applet.api_client import APIClient
+from ghaf_usb_applet.event_queue import BLOCK, DROP_OLDEST, OVERFLOW_EVENT
+from ghaf_usb_applet.logger import setup_logger
+from ghaf_usb_applet.mock_host import MockHost, synthetic_devices
+
+
+def bench_latency(client, requests, devices):
+    lists, attaches = [], []
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.usb_list()
+        lists.append(time.perf_counter() - start)
+    for i in range(requests):
+        dev = devices[i % len(devices)]
+        start = time.perf_counter()
+        client.usb_attach(dev["device_node"], dev["allowed_vms"][i % 2])
+        attaches.append(time.perf_counter() - start)
+    return lists, attaches
+
+
+def bench_attach_throughput(client, devices):
+    start = time.perf_counter()
+    for i, dev in enumerate(devices):
+        client.usb_attach(dev["device_node"], dev["allowed_vms"][i % 2])
+    serial = len(devices) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    futures = [
+        client.submit({"action": "usb_attach", "device_node": dev["device_node"],
+                       "vm": dev["allowed_vms"][(i + 1) % 2]})
+        for i, dev in enumerate(devices)
+    ]
+    for future in futures:
+        future.result()
+    pipelined = len(devices) / (time.perf_counter() - start)
+    return serial, pipelined
+
+
+def bench_batch(client, devices, rounds):
+    serial = batched = 0.0
+    for r in range(rounds):
+        vm = devices[0]["allowed_vms"][r % 2]
+        start = time.perf_counter()
+        for dev in devices:
+            client.usb_attach(dev["device_node"], vm)
+        serial += time.perf_counter() - start
+
+        vm = devices[0]["allowed_vms"][(r + 1) % 2]
+        start = time.perf_counter()
+        client.usb_attach_many([(dev["device_node"], vm) for dev in devices])
+        batched += time.perf_counter() - start
+    moved = len(devices) * rounds
+    return moved / serial, moved / batched
+
+
+def bench_fanout(host, transport, subscribers, events):
+    received = [0] * subscribers
+    latencies = []
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def _make_callback(idx):
+        def _callback(msg):
+            now = time.perf_counter()
+            with lock:
+                received[idx] += 1
+                latencies.append(now - msg["ts"])
+                if sum(received) == subscribers * events:
+                    done.set()
+        return _callback
+
+    clients = [
+        APIClient.recv_notifications(_make_callback(i), transport=transport)[1]
+        for i in range(subscribers)
+    ]
+    deadline = time.monotonic() + 5
+    while host.subscriber_count < subscribers and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    start = time.perf_counter()
+    for i in range(events):
+        host.push({"event": "usb_detached", "usb_device": {"device_node": f"/x/{i}"},
+                   "ts": time.perf_counter()})
+    done.wait(30)
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.close()
+    return sum(received) / elapsed, latencies
+
+
+def bench_slow_handler(host, transport, events, delay, overflow):
+    handled = []
+
+    def _callback(msg):
+        time.sleep(delay)
+        if msg.get("event") != OVERFLOW_EVENT:
+            handled.append(msg)
+
+    _thread, client = APIClient.recv_notifications(_callback, transport=transport,
+                                                   overflow=overflow)
+    deadline = time.monotonic() + 5
+    while host.subscriber_count < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    start = time.perf_counter()
+    for i in range(events):
+        host.push({"event": "usb_connected", "usb_device": {"device_node": f"/x/{i}"}})
+    pushed = time.perf_counter() - start
+    # Every pushed event is either handled or dropped by the queue once the
+    # reader has caught up; the queue being empty alone says nothing.
+    queue = client.dispatcher.queue
+    deadline = time.monotonic() + 10 + events * delay
+    while (len(handled) + queue.dropped + queue.superseded < events
+           and time.monotonic() < deadline):
+        time.sleep(0.01)
+    client.close()
+    return pushed, len(handled), queue.dropped + queue.superseded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="APIClient benchmarks against a mock host")
+    parser.add_argument("--fleets", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.001,
+                        help="Mock host per-request delay for the batch moves (sec)")
+    parser.add_argument("--subscribers", type=int, default=4)
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--slow-events", type=int, default=2000)
+    parser.add_argument("--slow-delay", type=float, default=0.001,
+                        help="Per-event handler time for the slow handler run (sec)")
+    parser.add_argument("--transport", type=str, default=None,
+                        help="unix:/path or tcp:127.0.0.1:0 (default: temp unix socket)")
+    parser.add_argument("--loglevel", type=str, default="error")
+    args = parser.parse_args()
+    setup_logger(args.loglevel)
+
+    tmpdir = tempfile.mkdtemp()
+    transport = args.transport or "unix:" + os.path.join(tmpdir, "mock.sock")
+
+    # Pipelining only pays off when the host overlaps requests; an in-order
+    # host answers a batch no faster than one request at a time.
+    for concurrent in (False, True):
+        print(f"{'concurrent' if concurrent else 'in-order'} host, "
+              f"{args.latency * 1000:g}ms per request")
+        for size in args.batches:
+            devices = synthetic_devices(size)
+            with MockHost(devices, transport, args.latency, concurrent) as host:
+                client = APIClient(transport=host.transport)
+                client.connect()
+                serial, batched = bench_batch(client, devices, args.rounds)
+                print(f"{f'move {size} devices':>24}: serial={serial:.0f}/s "
+                      f"usb_attach_many={batched:.0f}/s ({batched / serial:.1f}x)")
+                client.close()
+
+    for fleet in args.fleets:
+        devices = synthetic_devices(fleet)
+        with MockHost(devices, transport) as host:
+            client = APIClient(transport=host.transport)
+            client.connect()
+            print(f"fleet={fleet} transport={host.transport}")
+            lists, attaches = bench_latency(client, args.requests, devices)
+            report("usb_list latency", lists)
+            report("usb_attach latency", attaches)
+            serial, pipelined = bench_attach_throughput(client, devices)
+            print(f"{'attach throughput':>24}: serial={serial:.0f}/s pipelined={pipelined:.0f}/s")
+            rate, latencies = bench_fanout(host, host.transport, args.subscribers, args.events)
+            print(f"{'notification fan-out':>24}: {rate:.0f} deliveries/s "
+                  f"to {args.subscribers} subscribers")
+            report("notification latency", latencies)
+            client.close()
+
+    with MockHost([], transport) as host:
+        for overflow in (DROP_OLDEST, BLOCK):
+            pushed, handled, dropped = bench_slow_handler(
+                host, host.transport, args.slow_events, args.slow_delay, overflow
+            )
+            print(f"{f'slow handler {overflow}':>24}: host push {pushed * 1000:.1f}ms, "
+                  f"handled {handled}/{args.slow_events}, dropped {dropped}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Notification-to-window latency of the device chooser: one usb_device
+# process per prompt versus requests to a resident `usb_device --serve`.
+# Needs a graphical session and a reachable vHotplug host on --port.
+
+import argparse
+import socket
+import subprocess
+import time
+
+from common import LogWatcher, report
+from ghaf_usb_applet.chooser import chooser_socket_path, device_command, encode_request
+
+SHOWN = b"Device chooser shown"
+
+
+def sample_device(i):
+    return {
+        "device_node": f"/dev/bus/usb/001/{i:03d}",
+        "product_name": f"Bench device {i}",
+        "allowed_vms": ["eject", "vm1", "vm2"],
+        "vm": "",
+    }
+
+
+def bench_spawn(runs, port, timeout):
+    samples = []
+    for i in range(runs):
+        cmd = device_command(sample_device(i), "Bench", port) + ["--loglevel", "debug"]
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+        if LogWatcher(proc).wait_for(SHOWN, timeout):
+            samples.append(time.perf_counter() - start)
+        proc.terminate()
+        proc.wait()
+    return samples
+
+
+def bench_resident(runs, port, timeout):
+    proc = subprocess.Popen(
+        ["usb_device", "--serve", "--port", str(port), "--loglevel", "debug"],
+        stderr=subprocess.PIPE,
+    )
+    samples = []
+    log = LogWatcher(proc)
+    try:
+        if not log.wait_for(b"Device chooser service ready", timeout):
+            return samples
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(chooser_socket_path())
+        for i in range(runs):
+            start = time.perf_counter()
+            sock.sendall(encode_request(sample_device(i), "Bench"))
+            if log.wait_for(SHOWN, timeout):
+                samples.append(time.perf_counter() - start)
+        sock.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Device chooser latency benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--port", type=int, default=2000)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    args = parser.parse_args()
+    report("spawn", bench_spawn(args.runs, args.port, args.timeout))
+    report("resident", bench_resident(args.runs, args.port, args.timeout))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# FrameDecoder versus the previous str-concatenation line splitter, on one
+# large usb_list reply and on many small notification messages, both fed in
+# 4096-byte reads. Each is timed splitting frames only and with json.loads
+# on every frame, which is most of the cost for small messages.
+
+import argparse
+import json
+import time
+
+from ghaf_usb_applet.framing import FrameDecoder
+from ghaf_usb_applet.mock_host import synthetic_devices
+
+
+def _skip(_frame):
+    pass
+
+
+def legacy_decode(chunks, parse=json.loads):
+    frames = 0
+    buffer = ""
+    for data in chunks:
+        buffer += data.decode("utf-8")
+        while "\n" in buffer:
+            msg, buffer = buffer.split("\n", 1)
+            parse(msg)
+            frames += 1
+    return frames
+
+
+def framed_decode(chunks, parse=json.loads):
+    frames = 0
+    decoder = FrameDecoder()
+    for data in chunks:
+        for frame in decoder.feed(data):
+            parse(frame)
+            frames += 1
+    return frames
+
+
+def chunked(payload, size):
+    return [payload[i:i + size] for i in range(0, len(payload), size)]
+
+
+def workloads(devices, events):
+    listing = {"result": "ok", "usb_devices": synthetic_devices(devices)}
+    large = (json.dumps(listing) + "\n").encode("utf-8")
+    for dev in listing["usb_devices"]:
+        dev["product_name"] = "Тестовое_устройство_" + dev["product_name"]
+    large_utf8 = (json.dumps(listing, ensure_ascii=False) + "\n").encode("utf-8")
+    event = {"event": "usb_attached", "usb_device": synthetic_devices(1)[0], "vm": "comms-vm"}
+    small = ((json.dumps(event) + "\n") * events).encode("utf-8")
+    return {
+        "large usb_list": large,
+        "large usb_list, UTF-8 names": large_utf8,
+        "many small events": small,
+    }
+
+
+def timed(fn, chunks, repeat, parse):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(chunks, parse)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame decoder micro-benchmark")
+    parser.add_argument("--devices", type=int, default=5000)
+    parser.add_argument("--events", type=int, default=50000)
+    parser.add_argument("--chunk", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for name, payload in workloads(args.devices, args.events).items():
+        chunks = chunked(payload, args.chunk)
+        print(f"{name}: {len(payload)} bytes in {len(chunks)} reads")
+        print(f"  {'':18} {'split':>10} {'+json.loads':>12}")
+        try:
+            split = timed(legacy_decode, chunks, args.repeat, _skip)
+            parsed = timed(legacy_decode, chunks, args.repeat, json.loads)
+            print(f"  legacy str buffer: {split * 1000:8.2f}ms {parsed * 1000:10.2f}ms")
+        except UnicodeDecodeError as e:
+            print(f"  legacy str buffer: failed ({e.reason} at a read boundary)")
+        split = timed(framed_decode, chunks, args.repeat, _skip)
+        parsed = timed(framed_decode, chunks, args.repeat, json.loads)
+        print(f"  FrameDecoder:      {split * 1000:8.2f}ms {parsed * 1000:10.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Auto-routing: rule lookup cost for growing rule sets, and time from a
+# usb_select_vm notification to the usb_attached event for a device that
+# matches a rule, against the in-process mock vHotplug host. Without a
+# rule that time is however long the user takes in the chooser.
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from common import report
+from ghaf_usb_applet.api_client import APIClient
+from ghaf_usb_applet.logger import setup_logger
+from ghaf_usb_applet.mock_host import DEFAULT_VMS, MockHost, synthetic_devices
+from ghaf_usb_applet.routing import Router, Rule, RuleSet, save_rules
+
+
+def synthetic_rules(count):
+    rules = [
+        Rule(DEFAULT_VMS[i % len(DEFAULT_VMS)], i % 5, vid_pid=f"{0x1000 + i:04x}:{i:04x}")
+        for i in range(count)
+    ]
+    # A few broad rules that every lookup has to try.
+    rules.append(Rule(DEFAULT_VMS[0], -1, product_name="*keyboard*"))
+    rules.append(Rule(DEFAULT_VMS[1], -1, port_path="9-*"))
+    return rules
+
+
+def bench_lookup(count, lookups):
+    rules = RuleSet(synthetic_rules(count))
+    hit = {"vendor_id": f"{0x1000 + count // 2:04x}", "product_id": f"{count // 2:04x}",
+           "product_name": "Synthetic_Device", "port_path": "1-1"}
+    miss = dict(hit, vendor_id="ffff")
+    hits, misses = [], []
+    for _ in range(lookups):
+        start = time.perf_counter()
+        rules.lookup(hit, DEFAULT_VMS)
+        hits.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        rules.lookup(miss, DEFAULT_VMS)
+        misses.append(time.perf_counter() - start)
+    return hits, misses
+
+
+def bench_time_to_attach(devices, rounds):
+    workdir = tempfile.mkdtemp()
+    transport = "unix:" + os.path.join(workdir, "mock.sock")
+    rules_file = os.path.join(workdir, "rules.json")
+    save_rules([Rule(DEFAULT_VMS[1], vid_pid=f"{d['vendor_id']}:{d['product_id']}")
+                for d in devices], rules_file)
+    router = Router(rules_file)
+    samples = []
+    with MockHost([], transport) as host:
+        client = APIClient(transport=transport)
+        client.connect()
+        attached = threading.Event()
+
+        # The same decision USBDeviceNotification.show_notif_window makes.
+        def _on_event(msg):
+            if msg.get("event") == "usb_select_vm":
+                vm = router.route(msg["usb_device"], msg["allowed_vms"])
+                if vm is not None:
+                    client.submit({"action": "usb_attach",
+                                   "device_node": msg["usb_device"]["device_node"], "vm": vm})
+            elif msg.get("event") == "usb_attached":
+                attached.set()
+
+        _thread, listener = APIClient.recv_notifications(_on_event, transport=transport)
+        while host.subscriber_count == 0:
+            time.sleep(0.01)
+        for r in range(rounds):
+            dev = dict(devices[r % len(devices)], vm=None)
+            attached.clear()
+            start = time.perf_counter()
+            host.connect_device(dev, select_vm=True)
+            if attached.wait(5):
+                samples.append(time.perf_counter() - start)
+            host.disconnect_device(dev["device_node"])
+        listener.close()
+        client.close()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Auto-routing benchmarks")
+    parser.add_argument("--rules", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--loglevel", type=str, default="warning")
+    args = parser.parse_args()
+    setup_logger(args.loglevel, ring_size=0)
+
+    for count in args.rules:
+        print(f"rules={count}")
+        hits, misses = bench_lookup(count, args.lookups)
+        report("lookup-hit", hits, unit="us", scale=1e6)
+        report("lookup-miss", misses, unit="us", scale=1e6)
+    samples = bench_time_to_attach(synthetic_devices(20), args.rounds)
+    report("select-vm-to-attached", samples)
+
+
+if __name__ == "__main__":
+    main()
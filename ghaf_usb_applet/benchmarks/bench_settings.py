@@ -0,0 +1,81 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Settings window startup against the in-process mock host: time to the
+# first painted frame (loading state), time from the device list arriving
+# to it being painted, and resident memory once painted, for synthetic
+# fleets. Reads the window's built-in timing marks from a real
+# usb_settings process, so it needs a graphical session.
+
+import argparse
+import os
+import re
+import subprocess
+import tempfile
+import time
+
+from common import LogWatcher, report
+from ghaf_usb_applet.api_client import TRANSPORT_ENV
+from ghaf_usb_applet.mock_host import MockHost, synthetic_devices
+
+MARK = re.compile(rb"^ after ([0-9.]+) ms")
+
+
+def mark_ms(log, name, timeout):
+    if not log.wait_for(b"Settings " + name, timeout):
+        return None
+    match = MARK.match(log.buf)
+    return float(match.group(1)) if match else None
+
+
+def rss_kib(pid):
+    with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def bench_settings(runs, transport, timeout):
+    first_paint, render, rss = [], [], []
+    env = dict(os.environ, **{TRANSPORT_ENV: transport})
+    for _ in range(runs):
+        proc = subprocess.Popen(
+            ["usb_settings", "--loglevel", "debug"], stderr=subprocess.PIPE, env=env,
+        )
+        log = LogWatcher(proc)
+        try:
+            painted = mark_ms(log, b"first-paint", timeout)
+            loaded = mark_ms(log, b"devices-loaded", timeout)
+            shown = mark_ms(log, b"devices-painted", timeout)
+            if painted is not None:
+                first_paint.append(painted / 1000)
+            if loaded is not None and shown is not None:
+                render.append((shown - loaded) / 1000)
+                rss.append(rss_kib(proc.pid))
+        finally:
+            proc.terminate()
+            proc.wait()
+    return first_paint, render, rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Settings window startup benchmark")
+    parser.add_argument("--fleets", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=15.0)
+    args = parser.parse_args()
+
+    transport = "unix:" + os.path.join(tempfile.mkdtemp(), "mock.sock")
+    for fleet in args.fleets:
+        with MockHost(synthetic_devices(fleet), transport):
+            time.sleep(0.1)
+            print(f"fleet={fleet}")
+            first_paint, render, rss = bench_settings(args.runs, transport, args.timeout)
+            report("time-to-first-paint", first_paint)
+            report("list-to-painted", render)
+            report("RSS", rss, unit="MiB", scale=1 / 1024)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Applet startup: import cost of the tray module (python -X importtime),
+# the device snapshot against a live usb_list round trip, and time-to-icon
+# and time-to-menu of a real usb_applet process with a cold and a warm
+# snapshot cache. The applet runs must happen in a graphical session with
+# a tray host.
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import LogWatcher, report
+from ghaf_usb_applet.api_client import APIClient
+from ghaf_usb_applet.device_store import DeviceStore
+from ghaf_usb_applet.mock_host import MockHost, synthetic_devices
+from ghaf_usb_applet.snapshot import load_snapshot, save_snapshot
+
+
+def import_times(module, top):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE, text=True, check=False,
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(cumulative_us), int(self_us), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def bench_snapshot(fleet, rounds, latency):
+    """Seconds to a filled DeviceStore from the snapshot vs connecting and
+    sending usb_list, as the applet does at startup."""
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, "devices.json")
+    transport = "unix:" + os.path.join(workdir, "mock.sock")
+    restored, listed = [], []
+    with MockHost(synthetic_devices(fleet), transport, latency):
+        seed = DeviceStore()
+        client = APIClient(transport=transport)
+        client.connect()
+        seed.replace(client.usb_list())
+        client.close()
+        save_snapshot(seed.devices, path)
+        for _ in range(rounds):
+            start = time.perf_counter()
+            DeviceStore().restore(load_snapshot(path))
+            restored.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            client = APIClient(transport=transport)
+            client.connect()
+            DeviceStore().replace(client.usb_list())
+            listed.append(time.perf_counter() - start)
+            client.close()
+    return restored, listed
+
+
+def bench_applet(runs, port, timeout, warm):
+    """Time to icon and to the first device menu; ``warm`` primes the
+    snapshot cache with a run that is left up until it saves."""
+    icon, menu = [], []
+    cache = tempfile.mkdtemp()
+    env = dict(os.environ, XDG_CACHE_HOME=cache)
+    cmd = ["usb_applet", "--port", str(port), "--loglevel", "debug"]
+    if warm:
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, env=env)
+        try:
+            LogWatcher(proc).wait_for(b"Saved device snapshot", timeout)
+        finally:
+            proc.terminate()
+            proc.wait()
+    marker = b"Device menu shown from snapshot" if warm else b"Device menu populated"
+    for _ in range(runs):
+        if not warm:
+            env["XDG_CACHE_HOME"] = tempfile.mkdtemp()
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, env=env)
+        log = LogWatcher(proc)
+        try:
+            if log.wait_for(b"Indicator shown", timeout):
+                icon.append(time.perf_counter() - start)
+            if log.wait_for(marker, timeout):
+                menu.append(time.perf_counter() - start)
+        finally:
+            proc.terminate()
+            proc.wait()
+    return icon, menu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Applet startup benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=2000)
+    parser.add_argument("--timeout", type=float, default=15.0)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--fleets", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Mock host per-request delay (sec)")
+    parser.add_argument("--imports-only", action="store_true")
+    parser.add_argument("--no-applet", action="store_true",
+                        help="Skip the usb_applet runs (no graphical session)")
+    args = parser.parse_args()
+
+    print("Slowest imports of ghaf_usb_applet.applet (cumulative us, self us):")
+    for cumulative, self_us, name in import_times("ghaf_usb_applet.applet", args.top):
+        print(f"  {cumulative:>9} {self_us:>9}  {name}")
+    if args.imports_only:
+        return
+
+    for fleet in args.fleets:
+        print(f"fleet={fleet}")
+        restored, listed = bench_snapshot(fleet, args.rounds, args.latency)
+        report("snapshot-to-store", restored)
+        report("usb_list-to-store", listed)
+    if args.no_applet:
+        return
+
+    for warm in (False, True):
+        print("warm snapshot cache" if warm else "cold snapshot cache")
+        icon, menu = bench_applet(args.runs, args.port, args.timeout, warm)
+        report("time-to-icon", icon)
+        report("time-to-menu", menu)
+
+
+if __name__ == "__main__":
+    main()
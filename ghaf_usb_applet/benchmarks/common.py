@@ -0,0 +1,45 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import select
+import statistics
+import time
+
+
+class LogWatcher:
+    def __init__(self, proc):
+        self.proc = proc
+        self.buf = b""
+
+    def wait_for(self, marker, timeout):
+        deadline = time.monotonic() + timeout
+        while marker not in self.buf:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            ready, _, _ = select.select([self.proc.stderr], [], [], min(remaining, 0.05))
+            if ready:
+                data = os.read(self.proc.stderr.fileno(), 65536)
+                if not data:
+                    return False
+                self.buf += data
+        _, self.buf = self.buf.split(marker, 1)
+        return True
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return float("nan")
+    idx = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+
+def report(name, samples, unit="ms", scale=1000):
+    if not samples:
+        print(f"{name:>24}: no samples")
+        return
+    values = sorted(s * scale for s in samples)
+    print(f"{name:>24}: n={len(values)} median={statistics.median(values):.2f}{unit} "
+          f"p90={percentile(values, 90):.2f}{unit} p99={percentile(values, 99):.2f}{unit} "
+          f"max={values[-1]:.2f}{unit}")
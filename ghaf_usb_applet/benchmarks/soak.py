@@ -0,0 +1,409 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Soak test: drives synthetic hotplug traffic (connect, disconnect,
+# attach, detach, select-vm with auto-routing, forced refreshes) from the
+# in-process mock host through the notification and refresh paths, and
+# samples RSS, live Python objects by type, tracemalloc heap and the size
+# of every structure that must stay bounded. Exits with status 1 when
+# growth after warm-up exceeds the thresholds.
+#
+#   --mode headless  APIClient, event queue, routing and DeviceStore
+#                    (optionally through the broker); runs anywhere.
+#   --mode applet    a real USBApplet pumped on the GLib main loop with
+#                    periodic clear_menu() cycles; needs a graphical
+#                    session with a tray host.
+
+import argparse
+import collections
+import gc
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from ghaf_usb_applet.api_client import TRANSPORT_ENV, APIClient
+from ghaf_usb_applet.device_store import DeviceStore
+from ghaf_usb_applet.logger import setup_logger
+from ghaf_usb_applet.mock_host import DEFAULT_VMS, MockHost, synthetic_devices
+from ghaf_usb_applet.routing import Router, Rule, save_rules
+
+MiB = 1024 * 1024
+# Not a hotplug event: consumers cannot apply it and fall back to a
+# usb_list refresh, on the same thread that handles notifications.
+REFRESH_EVENT = {"event": "soak_refresh"}
+
+
+def rss_bytes():
+    with open("/proc/self/status", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def object_counts():
+    gc.collect()
+    return collections.Counter(type(o).__name__ for o in gc.get_objects())
+
+
+class Driver:
+    """Random hotplug traffic over a fixed pool of devices."""
+
+    def __init__(self, host, devices, seed, refresh_every, select_every):
+        self.host = host
+        self.pool = [dict(d, vm=None) for d in devices]
+        self.rng = random.Random(seed)
+        self.refresh_every = refresh_every
+        self.select_every = select_every
+        self.events = 0
+
+    def step(self):
+        self.events += 1
+        if self.refresh_every and self.events % self.refresh_every == 0:
+            self.host.push(REFRESH_EVENT)
+            return
+        dev = self.rng.choice(self.pool)
+        node = dev["device_node"]
+        present = node in self.host.devices
+        if not present:
+            select = self.select_every and self.events % self.select_every == 0
+            self.host.connect_device(dev, select_vm=select)
+        elif self.rng.random() < 0.15:
+            self.host.disconnect_device(node)
+        else:
+            vm = self.rng.choice(dev["allowed_vms"] + ["eject"])
+            if vm == "eject":
+                msg = {"action": "usb_detach", "device_node": node}
+            else:
+                msg = {"action": "usb_attach", "device_node": node, "vm": vm}
+            _reply, event = self.host.handle(msg, None)
+            if event is not None:
+                self.host.push(event)
+            else:
+                self.events -= 1
+
+
+class HeadlessSubject:
+    """The tray's notification and refresh logic without GTK."""
+
+    def __init__(self, transport, router):
+        self.router = router
+        self.store = DeviceStore()
+        self.client = APIClient(transport=transport)
+        self.client.connect()
+        self.refreshes = 0
+        _thread, self.listener = APIClient.recv_notifications(self.on_event, transport=transport)
+
+    def on_event(self, msg):
+        if msg.get("event") == "usb_select_vm":
+            vm = self.router.route(msg["usb_device"], msg.get("allowed_vms", []))
+            if vm is not None:
+                self.client.submit({"action": "usb_attach",
+                                    "device_node": msg["usb_device"]["device_node"], "vm": vm})
+            return
+        if not self.store.apply_event(msg):
+            self.refresh()
+
+    def refresh(self):
+        self.refreshes += 1
+        try:
+            self.store.replace(self.client.usb_list())
+        except (ConnectionError, TimeoutError) as e:
+            print(f"refresh failed: {e}", file=sys.stderr)
+
+    def pump(self, timeout):
+        time.sleep(timeout)
+
+    def busy(self):
+        return len(self.listener.dispatcher.queue) > 0
+
+    def cycle(self):
+        pass
+
+    def bounded(self):
+        return {
+            "store devices": len(self.store.devices),
+            "listener buffer": len(self.listener._decoder._buf),
+            "event queue": len(self.listener.dispatcher.queue),
+            "pending requests": len(self.client._pending),
+        }
+
+    def close(self):
+        self.listener.close()
+        self.client.close()
+
+
+class AppletSubject:
+    """A real USBApplet and notification monitor on the GLib main loop."""
+
+    def __init__(self, transport, router):
+        os.environ[TRANSPORT_ENV] = transport
+        # pylint: disable=import-outside-toplevel
+        from gi.repository import GLib
+        from ghaf_usb_applet.applet import USBApplet
+        from ghaf_usb_applet.notification_handler import USBDeviceNotification
+
+        self.context = GLib.MainContext.default()
+        self.applet = USBApplet()
+        self.applet._notify_error = lambda title, msg: print(f"{title}: {msg}", file=sys.stderr)
+        self.notif = USBDeviceNotification(apiclient=self.applet.apiclient, router=router)
+        self.listener = self.notif.monitor(
+            self.applet.on_device_event, self.applet.on_notifications_connected
+        )
+        self.store = self.applet.store
+        self.pump(1.0)
+
+    def pump(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            while self.context.pending():
+                self.context.iteration(False)
+            if time.monotonic() >= deadline:
+                return
+            time.sleep(0.001)
+
+    def busy(self):
+        return len(self.listener.dispatcher.queue) > 0 or self.applet.refresher.depth > 0
+
+    def cycle(self):
+        self.applet.clear_menu()
+        self.applet._render()
+
+    def bounded(self):
+        widgets = collections.Counter(
+            type(o).__name__ for o in gc.get_objects()
+            if type(o).__name__ in ("Menu", "MenuItem", "RadioMenuItem")
+        )
+        return {
+            "store devices": len(self.applet.store.devices),
+            "device_map": len(self.applet.device_map),
+            "device_items": len(self.applet.device_items),
+            "radio_groups": len(self.applet.radio_groups),
+            "menu children": len(self.applet.menu.get_children()),
+            "Menu wrappers": widgets["Menu"],
+            "MenuItem wrappers": widgets["MenuItem"],
+            "RadioMenuItem wrappers": widgets["RadioMenuItem"],
+            "pending moves": len(self.applet._pending),
+            "listener buffer": len(self.listener._decoder._buf),
+            "event queue": len(self.listener.dispatcher.queue),
+            "pending requests": len(self.applet.apiclient._pending),
+        }
+
+    def close(self):
+        self.listener.close()
+        self.applet.apiclient.close()
+
+
+def limits(pool, allowed):
+    """Upper bounds for bounded() once the subject is idle."""
+    return {
+        "store devices": pool,
+        "device_map": pool,
+        "device_items": pool,
+        "radio_groups": pool,
+        # Devices, status row, "Move all to", "Eject all", "Settings".
+        "menu children": pool + 4,
+        "Menu wrappers": pool + 2,
+        "MenuItem wrappers": pool + 4 + len(DEFAULT_VMS),
+        "RadioMenuItem wrappers": pool * (allowed + 1),
+        "pending moves": 0,
+        "listener buffer": 65536,
+        "event queue": 0,
+        "pending requests": 0,
+    }
+
+
+class Sampler:
+    def __init__(self, subject, top):
+        self.subject = subject
+        self.top = top
+        self.rows = []
+        self.counts = None
+        self.snapshot = None
+        self.warm = None
+
+    def sample(self, events, elapsed, warm=False):
+        counts = object_counts()
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        row = {
+            "events": events,
+            "elapsed": elapsed,
+            "rss": rss_bytes(),
+            "heap": traced,
+            "objects": sum(counts.values()),
+            "bounded": self.subject.bounded(),
+        }
+        self.rows.append(row)
+        if warm:
+            self.warm = row
+            self.counts = counts
+            if tracemalloc.is_tracing():
+                self.snapshot = tracemalloc.take_snapshot()
+        print(f"{events:>8} {elapsed:>7.1f}s rss={row['rss'] / MiB:>7.1f}MiB "
+              f"heap={traced / MiB:>6.2f}MiB objects={row['objects']:>8} "
+              f"devices={row['bounded']['store devices']}", flush=True)
+        return counts
+
+    def growth(self, counts):
+        diff = counts.copy()
+        diff.subtract(self.counts)
+        return [(name, n) for name, n in diff.most_common(self.top) if n > 0]
+
+    def top_allocators(self):
+        if self.snapshot is None:
+            return []
+        current = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        return current.compare_to(self.snapshot, "lineno")[:self.top]
+
+
+def run(args):
+    workdir = tempfile.mkdtemp()
+    transport = "unix:" + os.path.join(workdir, "mock.sock")
+    devices = synthetic_devices(args.pool)
+    rules_file = os.path.join(workdir, "rules.json")
+    save_rules([Rule(DEFAULT_VMS[i % len(DEFAULT_VMS)],
+                     vid_pid=f"{d['vendor_id']}:{d['product_id']}")
+                for i, d in enumerate(devices)], rules_file)
+    os.environ["XDG_CACHE_HOME"] = workdir
+    router = Router(rules_file)
+    if args.tracemalloc:
+        tracemalloc.start(1)
+
+    with MockHost(devices, transport) as host:
+        broker = None
+        target = transport
+        if args.broker:
+            # pylint: disable=import-outside-toplevel
+            from ghaf_usb_applet.broker import Broker
+            broker = Broker(os.path.join(workdir, "broker.sock"), upstream=transport).start()
+            target = "unix:" + broker.path
+        if args.mode == "applet":
+            subject = AppletSubject(target, router)
+        else:
+            subject = HeadlessSubject(target, router)
+        deadline = time.monotonic() + 5
+        while host.subscriber_count < 1 + bool(broker) and time.monotonic() < deadline:
+            subject.pump(0.01)
+
+        driver = Driver(host, devices, args.seed, args.refresh_every, args.select_every)
+        sampler = Sampler(subject, args.top)
+        warmup = int(args.events * args.warmup)
+        every = max(1, args.events // args.samples)
+
+        def _quiesce():
+            deadline = time.monotonic() + 10
+            subject.pump(0.05)
+            while subject.busy() and time.monotonic() < deadline:
+                subject.pump(0.05)
+            subject.pump(0.2)
+
+        start = time.perf_counter()
+        marks = list(range(every, args.events + 1, every))
+        if warmup not in marks:
+            marks = sorted(marks + [max(1, warmup)])
+        final = None
+        for mark in marks:
+            # Drive in slices so samples are taken with the subject idle.
+            thread = threading.Thread(target=_slice, args=(driver, mark), daemon=True)
+            thread.start()
+            while thread.is_alive():
+                subject.pump(0.01)
+            if args.cycle_every and mark % args.cycle_every < every:
+                subject.cycle()
+            _quiesce()
+            final = sampler.sample(driver.events, time.perf_counter() - start,
+                                   warm=mark == max(1, warmup))
+
+        failures = check(args, sampler, final, limits(args.pool, len(DEFAULT_VMS)))
+        subject.close()
+        if broker is not None:
+            broker.stop()
+    return failures
+
+
+def _slice(driver, until):
+    while driver.events < until:
+        driver.step()
+
+
+def check(args, sampler, counts, bounds):
+    failures = []
+    warm, last = sampler.warm, sampler.rows[-1]
+    rss = (last["rss"] - warm["rss"]) / MiB
+    heap = (last["heap"] - warm["heap"]) / MiB
+    objects = last["objects"] - warm["objects"]
+    print(f"\ngrowth after warm-up ({warm['events']} -> {last['events']} events): "
+          f"rss {rss:+.1f}MiB heap {heap:+.2f}MiB objects {objects:+d}")
+    if rss > args.max_rss_growth:
+        failures.append(f"RSS grew {rss:.1f}MiB > {args.max_rss_growth}MiB")
+    if tracemalloc.is_tracing() and heap > args.max_heap_growth:
+        failures.append(f"traced heap grew {heap:.2f}MiB > {args.max_heap_growth}MiB")
+    if objects > args.max_object_growth:
+        failures.append(f"live objects grew by {objects} > {args.max_object_growth}")
+
+    growth = sampler.growth(counts)
+    if growth:
+        print("object types that grew:")
+        for name, n in growth:
+            print(f"  {n:>+8}  {name}")
+    allocators = sampler.top_allocators()
+    if allocators:
+        print("top allocators since warm-up:")
+        for stat in allocators:
+            print(f"  {stat}")
+
+    print("bounded structures (end / limit):")
+    for name, value in last["bounded"].items():
+        limit = bounds.get(name)
+        flag = "" if limit is None or value <= limit else "  <-- over limit"
+        print(f"  {name:>24}: {value} / {limit}{flag}")
+        if flag:
+            failures.append(f"{name} is {value}, limit {limit}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak and memory-growth test")
+    parser.add_argument("--mode", choices=("headless", "applet"), default="headless")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--pool", type=int, default=64, help="Synthetic devices")
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--warmup", type=float, default=0.1,
+                        help="Fraction of events before the baseline sample")
+    parser.add_argument("--refresh-every", type=int, default=500,
+                        help="Force a usb_list refresh every N events (0: never)")
+    parser.add_argument("--select-every", type=int, default=10,
+                        help="Every Nth connect asks for a VM and is auto-routed")
+    parser.add_argument("--cycle-every", type=int, default=5000,
+                        help="Applet: clear_menu() and rebuild every N events (0: never)")
+    parser.add_argument("--broker", action="store_true", help="Go through a USB broker")
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false")
+    parser.add_argument("--max-rss-growth", type=float, default=16.0, help="MiB")
+    parser.add_argument("--max-heap-growth", type=float, default=2.0, help="MiB")
+    parser.add_argument("--max-object-growth", type=int, default=2000)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--loglevel", type=str, default="error")
+    parser.add_argument("--log-ring", type=int, default=0,
+                        help="Keep the last N log records of every level, as with "
+                             "GHAF_USB_LOG_RING (0: off)")
+    args = parser.parse_args()
+    setup_logger(args.loglevel, ring_size=args.log_ring)
+
+    failures = run(args)
+    if failures:
+        print("\nFAIL")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\nPASS")
+
+
+if __name__ == "__main__":
+    main()
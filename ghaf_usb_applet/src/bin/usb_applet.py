@@ -3,14 +3,22 @@
 
 from ghaf_usb_applet.applet import start_usb_applet
 from ghaf_usb_applet.logger import setup_logger
+from ghaf_usb_applet.profiling import setup_profiling
+from ghaf_usb_applet.metrics import setup_metrics
 import argparse
 
 def main():
     parser = argparse.ArgumentParser(description="USB Device Applet")
     parser.add_argument("--loglevel", type=str, default="info", help="Log level")
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="Export metrics to textfile:/path or unix:/path")
     parser.add_argument("--port", type=int, default=2000, help="vHotplg server port")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile hot paths; SIGUSR2 toggles it at runtime")
     args = parser.parse_args()
     setup_logger(args.loglevel)
+    setup_profiling(args.profile)
+    setup_metrics(args.metrics)
     start_usb_applet(args.port)
     alert.main()
     
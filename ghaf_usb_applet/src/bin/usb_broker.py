@@ -0,0 +1,29 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+import argparse
+from ghaf_usb_applet.broker import run_broker
+from ghaf_usb_applet.logger import setup_logger
+from ghaf_usb_applet.metrics import setup_metrics
+from ghaf_usb_applet.profiling import setup_profiling
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-session USB API broker")
+    parser.add_argument("--loglevel", type=str, default="info", help="Log level")
+    parser.add_argument("--port", type=int, default=2000, help="vHotplug server port")
+    parser.add_argument("--socket", type=str, default=None,
+                        help="Listen socket (default $XDG_RUNTIME_DIR/ghaf-usb-broker.sock)")
+    parser.add_argument("--upstream", type=str, default=None,
+                        help="Upstream transport: vsock, unix:/path or tcp:host:port")
+    parser.add_argument("--metrics", type=str, default=None,
+                        help="Export metrics to textfile:/path or unix:/path")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile hot paths; SIGUSR2 toggles it at runtime")
+    args = parser.parse_args()
+    setup_logger(args.loglevel)
+    setup_profiling(args.profile)
+    setup_metrics(args.metrics)
+    run_broker(args.socket, port=args.port, upstream=args.upstream)
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,8 @@
 
 import argparse
 from ghaf_usb_applet.logger import setup_logger
-from ghaf_usb_applet.vm_selection import show_device_setting
+from ghaf_usb_applet.profiling import setup_profiling
+from ghaf_usb_applet.vm_selection import show_device_setting, serve_device_chooser
 
 def parse_args():
     parser = argparse.ArgumentParser(description="USB Device Notification")
@@ -14,20 +15,30 @@ def parse_args():
                         help="Log level")
     parser.add_argument("--port", type=int, default=2000,
                         help="vHotPlug server port")
-    parser.add_argument("--device_node", type=str, required=True,
+    parser.add_argument("--device_node", type=str,
                         help="Device node path, e.g. /dev/bus/usb/001/004")
-    parser.add_argument("--product_name", type=str, required=True,
+    parser.add_argument("--product_name", type=str,
                         help="Product name of the device")
-    parser.add_argument("--allowed_vms", nargs="+", required=True,
+    parser.add_argument("--allowed_vms", nargs="+",
                         help="List of allowed VMs (space-separated)")
     parser.add_argument("--vm", type=str, default="",
                         help="Currently selected VM")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as resident device chooser service")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile hot paths; SIGUSR2 toggles it at runtime")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.serve and not (args.device_node and args.product_name and args.allowed_vms):
+        parser.error("--device_node, --product_name and --allowed_vms are required")
+    return args
 
 def main():
     args = parse_args()
     setup_logger(args.loglevel)
+    setup_profiling(args.profile)
+    if args.serve:
+        serve_device_chooser(port = args.port)
     device = {
         "device_node": args.device_node,
         "product_name": args.product_name,
@@ -4,6 +4,7 @@
 import argparse
 from ghaf_usb_applet.notification_handler import USBDeviceNotification
 from ghaf_usb_applet.logger import setup_logger
+from ghaf_usb_applet.metrics import setup_metrics
 
 def build_parser():
     p = argparse.ArgumentParser(description="USB Device notifier")
@@ -11,11 +12,14 @@ def build_parser():
         "--port", type=int, default=2000, help="Host vsock listen port (default 7000)"
     )
     p.add_argument("--loglevel", type=str, default="info", help="Log level")
+    p.add_argument("--metrics", type=str, default=None,
+                   help="Export metrics to textfile:/path or unix:/path")
     return p
 
 def main():
     args = build_parser().parse_args()
     setup_logger(args.loglevel)
+    setup_metrics(args.metrics)
     USBDeviceNotification(server_port = args.port)
 
 if __name__ == "__main__":
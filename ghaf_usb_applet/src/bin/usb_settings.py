@@ -5,6 +5,8 @@ import argparse
 
 from ghaf_usb_applet.settings import SettingsMenu
 from ghaf_usb_applet.logger import setup_logger
+from ghaf_usb_applet.profiling import setup_profiling
+from ghaf_usb_applet.metrics import setup_metrics
 
 def build_parser():
     p = argparse.ArgumentParser(description="USB Device Settings")
@@ -12,11 +14,17 @@ def build_parser():
         "--port", type=int, default=2000, help="Host vsock listen port (default 7000)"
     )
     p.add_argument("--loglevel", type=str, default="info", help="Log level")
+    p.add_argument("--profile", action="store_true",
+                   help="Profile hot paths; SIGUSR2 toggles it at runtime")
+    p.add_argument("--metrics", type=str, default=None,
+                   help="Export metrics to textfile:/path or unix:/path")
     return p.parse_args()
 
 def main():
     args = build_parser()
     setup_logger(args.loglevel)
+    setup_profiling(args.profile)
+    setup_metrics(args.metrics)
     app = SettingsMenu(args.port)
     raise SystemExit(app.run())
 
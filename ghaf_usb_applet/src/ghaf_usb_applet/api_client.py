@@ -1,132 +1,538 @@
 # Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
 # SPDX-License-Identifier: Apache-2.0
 
+import heapq
+import itertools
+import os
+import random
 import socket
 import json
 import threading
 import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, InvalidStateError, wait
+
+from ghaf_usb_applet import metrics
+from ghaf_usb_applet.devices import DeviceRegistry, EJECT
+from ghaf_usb_applet.event_queue import DEFAULT_QUEUE_SIZE, DROP_OLDEST, ThreadedDispatcher
+from ghaf_usb_applet.framing import FrameDecoder, FrameTooLarge
+from ghaf_usb_applet.logger import log_entry_exit, logger
+
+TRANSPORT_ENV = "GHAF_USB_API_TRANSPORT"
+TIMEOUT_ENV = "GHAF_USB_API_TIMEOUT"
+BROKER_ENV = "GHAF_USB_BROKER_SOCKET"
+BROKER_SOCKET = "ghaf-usb-broker.sock"
+DEFAULT_TIMEOUT = 10.0
+# Sentinel for "use the client's default timeout"; None means no deadline.
+DEFAULT = object()
+
+
+class APITimeout(TimeoutError):
+    """An API request got no reply before its deadline."""
+
+
+def default_timeout():
+    """Request deadline in seconds from $GHAF_USB_API_TIMEOUT; 0 disables it."""
+    value = os.environ.get(TIMEOUT_ENV)
+    if not value:
+        return DEFAULT_TIMEOUT
+    try:
+        timeout = float(value)
+    except ValueError:
+        logger.warning("Ignoring invalid %s=%r", TIMEOUT_ENV, value)
+        return DEFAULT_TIMEOUT
+    return timeout if timeout > 0 else None
+
+
+def broker_path():
+    """Socket of the per-session broker: $GHAF_USB_BROKER_SOCKET or $XDG_RUNTIME_DIR."""
+    path = os.environ.get(BROKER_ENV)
+    if path:
+        return path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    return os.path.join(runtime_dir, BROKER_SOCKET) if runtime_dir else None
+
+
+def route_request(device_node, vm):
+    if vm == EJECT:
+        return {"action": "usb_detach", "device_node": device_node}
+    return {"action": "usb_attach", "device_node": device_node, "vm": vm}
+
+
+def batch_result(future):
+    try:
+        return future.result()
+    except (ConnectionError, TimeoutError) as e:
+        return {"result": "failed", "error": str(e)}
+    except CancelledError:
+        return {"result": "failed", "error": "cancelled"}
+
+
+def is_success(response):
+    return response.get("result") == "ok" or response.get("event") in (
+        "usb_attached", "usb_detached"
+    )
+
+
+def request_outcome(future):
+    if future.cancelled():
+        return "cancelled"
+    error = future.exception()
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    if error is not None:
+        return "error"
+    return "ok" if is_success(future.result()) else "failed"
+
+
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+CONNECTED = "connected"
+RECONNECTING = "reconnecting"
+
+
+class DeadlineSweeper:
+    """Expires futures at their deadlines from one daemon thread.
+
+    Deadlines are kept in a heap; futures that settle before theirs are
+    skipped when they reach the top, and swept out in bulk if they pile up.
+    Entries hold futures weakly, so a settled reply is not kept alive
+    until its deadline.
+    """
+
+    COMPACT_AT = 256
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._compact_at = self.COMPACT_AT
+        self._thread = None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def add(self, future, timeout, expire):
+        """Call ``expire(future, timeout)`` in ``timeout`` sec unless it is done."""
+        entry = (time.monotonic() + timeout, next(self._seq), weakref.ref(future),
+                 expire, timeout)
+        with self._cond:
+            if len(self._heap) >= self._compact_at:
+                self._heap = [e for e in self._heap if not _settled(e)]
+                heapq.heapify(self._heap)
+                self._compact_at = max(self.COMPACT_AT, 2 * len(self._heap))
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name="api-deadlines")
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and _settled(self._heap[0]):
+                        heapq.heappop(self._heap)
+                    delay = self._heap[0][0] - time.monotonic() if self._heap else None
+                    if delay is not None and delay <= 0:
+                        break
+                    self._cond.wait(delay)
+                _deadline, _seq, ref, expire, timeout = heapq.heappop(self._heap)
+            future = ref()
+            if future is not None:
+                expire(future, timeout)
+
+
+def _settled(entry):
+    future = entry[2]()
+    return future is None or future.done()
+
+
+_sweeper = DeadlineSweeper()
+
+
+class Backoff:
+    def __init__(self, initial=0.5, maximum=30.0, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
 
-from ghaf_usb_applet.logger import logger
 
 class APIClient:
-    def __init__(self, port=2000, cid=2):
+    def __init__(self, port=2000, cid=2, transport=None, timeout=DEFAULT):
+        self.name = "api"
         self.port = port
         self.cid = cid
+        self.timeout = default_timeout() if timeout is DEFAULT else timeout
+        # Without an explicit transport, dial the session broker when it is
+        # running and fall back to the host after a failed broker dial.
+        self.transport = transport or os.environ.get(TRANSPORT_ENV)
+        self.auto_transport = self.transport is None
+        self._skip_broker = False
+        self._dialled_broker = False
         self.sock = None
+        self.on_event = None
+        self.dispatcher = None
+        self.on_state = None
+        self.state = DISCONNECTED
+        self.auto_reconnect = False
+        self.backoff = Backoff()
+        self._next_dial = 0.0
+        self._connects = 0
+        self._stopped = False
+        self._ids = itertools.count(1)
+        self._pending = OrderedDict()
+        self._pending_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._reader = None
+        self._decoder = FrameDecoder()
 
-    def connect(self):
+    def _resolve_transport(self):
+        if not self.auto_transport:
+            return self.transport
+        path = broker_path()
+        self._dialled_broker = bool(path) and not self._skip_broker and os.path.exists(path)
+        return f"unix:{path}" if self._dialled_broker else "vsock"
+
+    def _dial_failed(self):
+        if self._dialled_broker:
+            logger.warning("USB broker unavailable, connecting to the host directly")
+            self._skip_broker = True
+
+    def _create_socket(self):
+        transport = self._resolve_transport()
+        kind, _, address = transport.partition(":")
+        if kind == "unix":
+            logger.info("Connecting to unix socket %s", address)
+            return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), address
+        if kind == "tcp":
+            host, _, port = address.rpartition(":")
+            if not host:
+                host, port = address or "127.0.0.1", self.port
+            logger.info("Connecting to tcp %s port %s", host, port)
+            return socket.socket(socket.AF_INET, socket.SOCK_STREAM), (host, int(port))
+        if kind != "vsock":
+            raise ValueError(f"Unknown API transport: {transport}")
         logger.info("Connecting to vsock cid %s on port %s", self.cid, self.port)
-        self.sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
-        self.sock.connect((self.cid, self.port))
+        return socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM), (self.cid, self.port)
+
+    def connect(self):
+        self._stopped = False
+        self._set_state(CONNECTING)
+        try:
+            sock, address = self._create_socket()
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(address)
+                sock.settimeout(None)
+            except OSError:
+                sock.close()
+                raise
+        except OSError:
+            self._dial_failed()
+            self._set_state(RECONNECTING if self.auto_reconnect else DISCONNECTED)
+            raise
+        self._connected(sock)
+
+    def _connected(self, sock):
         logger.info("Connected")
+        self.sock = sock
+        self._decoder.reset()
+        if self._connects:
+            metrics.inc("ghaf_usb_api_reconnects_total", client=self.name)
+        self._connects += 1
+        self._skip_broker = False
+        self.backoff.reset()
+        self._start_reader(sock)
+        self._set_state(CONNECTED)
 
-    def send(self, msg):
-        data = json.dumps(msg) + "\n"
-        self.sock.sendall(data.encode("utf-8"))
-        return self.recv()
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        logger.debug("API connection %s -> %s", self.state, state)
+        self.state = state
+        if self.on_state is not None:
+            try:
+                self.on_state(state)
+            except Exception:
+                logger.exception("API state handler failed")
 
-    def recv(self):
-        buffer = ""
-        while True:
-            data = self.sock.recv(4096)
-            if not data:
-                logger.info("API connection closed by remote")
-                break
-            buffer += data.decode("utf-8")
-            while "\n" in buffer:
-                msg, buffer = buffer.split("\n", 1)
-                try:
-                    return json.loads(msg)
-                except ValueError:
-                    logger.error("Invalid JSON in API response: %s", msg)
+    def _redial(self):
+        if time.monotonic() < self._next_dial:
+            return
+        try:
+            self.connect()
+        except OSError as e:
+            metrics.inc("ghaf_usb_api_dial_failures_total", client=self.name)
+            delay = self.backoff.next_delay()
+            self._next_dial = time.monotonic() + delay
+            logger.warning("API reconnect failed: %s, next attempt in %.1f sec", e, delay)
+
+    def _start_reader(self, sock):
+        self._reader = threading.Thread(target=self._read_loop, args=(sock,), daemon=True)
+        self._reader.start()
+
+    def _timeout(self, timeout):
+        return self.timeout if timeout is DEFAULT else timeout
+
+    @log_entry_exit
+    def submit(self, msg, timeout=DEFAULT):
+        """Send ``msg`` and return a Future for its reply.
+
+        The future may be cancelled by the caller. A cancelled or expired
+        request keeps its slot in the pending table until its reply arrives
+        (or the connection drops), so a late reply is discarded instead of
+        being matched to a newer request.
+        """
+        if self.sock is None and self.auto_reconnect and not self._stopped:
+            self._redial()
+        future = self._send_request(msg)
+        if not future.done():
+            self._arm_deadline(future, self._timeout(timeout))
+        self._track(future, msg)
+        return future
+
+    def _track(self, future, msg):
+        if metrics.ENABLED:
+            metrics.track_future(
+                "ghaf_usb_api_request", future, request_outcome,
+                action=msg.get("action"), client=self.name,
+            )
+
+    def _send_request(self, msg):
+        future = Future()
+        if self.sock is None:
+            future.set_exception(ConnectionError("API not connected"))
+            return future
+        req_id = next(self._ids)
+        data = (json.dumps(dict(msg, id=req_id)) + "\n").encode("utf-8")
+        with self._pending_lock:
+            self._pending[req_id] = future
+        try:
+            with self._send_lock:
+                self.sock.sendall(data)
+        except (OSError, AttributeError) as e:
+            with self._pending_lock:
+                self._pending.pop(req_id, None)
+            future.set_exception(ConnectionError(f"API send failed: {e}"))
+        return future
+
+    def _arm_deadline(self, future, timeout):
+        # Futures from submit() get their deadline even when nobody waits
+        # on them in _wait(); one shared thread expires them all.
+        if timeout is not None:
+            _sweeper.add(future, timeout, self._expire)
+
+    def _expire(self, future, timeout):
+        error = APITimeout(f"API request timed out after {timeout:g} sec")
+        if resolve_future(future, error=error):
+            logger.warning("API request timed out after %g sec", timeout)
+
+    def _wait(self, future, timeout):
+        timeout = self._timeout(timeout)
+        done, _ = wait([future], timeout)
+        if not done:
+            self._expire(future, timeout)
+        return future.result()
+
+    def send(self, msg, timeout=DEFAULT):
+        return self._wait(self.submit(msg, timeout), timeout)
+
+    def _read_loop(self, sock):
+        try:
+            while True:
+                if not self._decoder.recv_into(sock):
+                    logger.info("API connection closed by remote")
+                    break
+                self._dispatch_frames()
+        except FrameTooLarge as e:
+            logger.error("API protocol error: %s", e)
+        except OSError as e:
+            if self.sock is sock:
+                logger.warning("API connection error: %s", e)
+        finally:
+            if self.sock is sock:
+                self._drop_connection()
+
+    @log_entry_exit
+    def _dispatch_frames(self):
+        for frame in self._decoder.frames():
+            self._dispatch(frame)
+
+    def _dispatch(self, line):
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            logger.error("Invalid JSON in API response: %s", line)
+            return
+        if not isinstance(msg, dict):
+            logger.error("Unexpected API message: %s", msg)
+            return
+        future = self._match_pending(msg)
+        if future is not None:
+            if not resolve_future(future, msg):
+                logger.debug("Dropping reply to expired or cancelled request: %s", msg)
+        elif self.on_event is not None:
+            try:
+                self.on_event(msg)
+            except Exception:
+                logger.exception("API event handler failed")
+        else:
+            logger.debug("Unsolicited API message: %s", msg)
+
+    def _match_pending(self, msg):
+        with self._pending_lock:
+            req_id = msg.get("id")
+            if req_id is not None:
+                return self._pending.pop(req_id, None)
+            # Replies without an id are matched in order; pushed events go
+            # to on_event on a notification connection.
+            if "event" in msg and self.on_event is not None:
+                return None
+            if self._pending:
+                return self._pending.popitem(last=False)[1]
         return None
 
+    def _fail_pending(self, exc):
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            resolve_future(future, error=exc)
+
+    def _release_socket(self):
+        sock, self.sock = self.sock, None
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def _drop_connection(self):
+        self._release_socket()
+        self._fail_pending(ConnectionError("API connection lost"))
+        self._set_state(RECONNECTING if self.auto_reconnect else DISCONNECTED)
+
     def close(self):
-        if self.sock:
-            self.sock.close()
+        self._stopped = True
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        self._release_socket()
+        self._fail_pending(ConnectionError("API connection closed"))
+        self._set_state(DISCONNECTED)
 
-    def enable_notifications(self):
-        response = self.send({"action": "enable_notifications"})
+    def enable_notifications(self, timeout=DEFAULT):
+        response = self.send({"action": "enable_notifications"}, timeout)
         if response.get("result") != "ok":
             logger.error("Failed to enable notifications: %s", response)
+        return response
+
+    @log_entry_exit
+    def usb_list(self, timeout=DEFAULT):
+        return self.send({"action": "usb_list"}, timeout)
 
-    def usb_list(self):
-        return self.send({"action": "usb_list"})
+    @log_entry_exit
+    def usb_attach(self, device_node, vm, timeout=DEFAULT):
+        return self.send(
+            {"action": "usb_attach", "device_node": device_node, "vm": vm}, timeout
+        )
 
-    def usb_attach(self, device_node, vm):
-        return self.send({"action": "usb_attach", "device_node": device_node, "vm": vm})
+    @log_entry_exit
+    def usb_detach(self, device_node, timeout=DEFAULT):
+        return self.send({"action": "usb_detach", "device_node": device_node}, timeout)
 
-    def usb_detach(self, device_node):
-        return self.send({"action": "usb_detach", "device_node": device_node})
+    def submit_many(self, assignments, timeout=DEFAULT):
+        return [
+            (node, vm, self.submit(route_request(node, vm), timeout))
+            for node, vm in assignments
+        ]
 
-    # pylint: disable=too-many-positional-arguments
+    @log_entry_exit
+    def usb_attach_many(self, assignments, timeout=DEFAULT):
+        timeout = self._timeout(timeout)
+        submitted = self.submit_many(assignments, timeout)
+        _done, late = wait([future for _node, _vm, future in submitted], timeout)
+        for future in late:
+            self._expire(future, timeout)
+        return [(node, vm, batch_result(future)) for node, vm, future in submitted]
+
+    def usb_detach_many(self, device_nodes, timeout=DEFAULT):
+        return self.usb_attach_many(((node, EJECT) for node in device_nodes), timeout)
+
+    # pylint: disable=too-many-positional-arguments,too-many-arguments
     @classmethod
-    def recv_notifications(cls, callback, port=2000, cid=2, reconnect_delay=3):
-        client = cls(port=port, cid=cid)
+    def recv_notifications(cls, callback, port=2000, cid=2, reconnect_delay=3, transport=None,
+                           queue_size=DEFAULT_QUEUE_SIZE, overflow=DROP_OLDEST,
+                           on_connected=None):
+        """Call ``callback(event)`` for every notification on a worker thread.
+
+        Events wait in a bounded queue (see event_queue.py) so the reader
+        never waits for the callback; ``overflow`` picks what happens when
+        ``queue_size`` events are pending. ``on_connected()`` is called
+        each time the host has acknowledged the subscription.
+        """
+        client = cls(port=port, cid=cid, transport=transport)
+        client.name = "notifications"
+        client.dispatcher = ThreadedDispatcher(callback, queue_size, overflow, client.name)
+        client.on_event = client.dispatcher
+
+        client.backoff = Backoff(initial=reconnect_delay)
 
         def _listener():
-            while True:
+            while not client._stopped:
                 try:
                     client.connect()
-                    client.enable_notifications()
-
-                    buffer = ""
-                    while True:
-                        data = client.sock.recv(4096)
-                        if not data:
-                            raise ConnectionError(
-                                "API connection for notifications closed by remote"
-                            )
-                        buffer += data.decode("utf-8")
-                        while "\n" in buffer:
-                            msg, buffer = buffer.split("\n", 1)
-                            try:
-                                parsed = json.loads(msg)
-                                callback(parsed)
-                            except ValueError:
-                                logger.error(
-                                    "Invalid JSON in API notification: %s", msg
-                                )
+                    if client.enable_notifications().get("result") == "ok" and on_connected:
+                        on_connected()
+                    client._reader.join()
+                    raise ConnectionError(
+                        "API connection for notifications closed by remote"
+                    )
                 except OSError as e:
+                    if client._stopped:
+                        break
+                    delay = client.backoff.next_delay()
                     logger.warning("Notification listener error: %s", e)
-                    logger.warning("Reconnecting in %s sec...", reconnect_delay)
-                finally:
-                    client.close()
-                    time.sleep(reconnect_delay)
+                    logger.warning("Reconnecting in %.1f sec...", delay)
+                    client._drop_connection()
+                    time.sleep(delay)
 
         thread = threading.Thread(target=_listener, daemon=True)
         thread.start()
         return thread, client
 
-    def get_devices_pretty(self):
-        devices = self.usb_list()
-        logger.debug(f"{devices}")
-        device_map = {}
-        unique_idx = 1
-        if devices.get("result") == "ok":
-            for dev in devices.get("usb_devices", []):
-                print(dev)
-                allowed_vms = dev.get("allowed_vms", None)
-                if allowed_vms is None or len(allowed_vms) == 0:
-                    continue
-                if 'eject' not in allowed_vms:
-                    allowed_vms = allowed_vms.insert(0, 'eject')
-                vm = dev.get("vm", None)
-                if vm is None:
-                    dev['vm'] = 'eject'         
-                if "device_node" in dev and "product_name" in dev:
-                    product_name = dev.get("product_name")
-                    if product_name is None:
-                        continue
-
-                    if product_name.isdigit():
-                        product_name = "<unknown device>"
-                    product_name = product_name.replace('_', " ")
-                    if product_name not in device_map:
-                        device_map[product_name] = dev
-                    else:
-                        product_name = product_name + "(" + str(unique_idx) + ")"
-                        device_map[product_name] = dev
-                        unique_idx += 1
-        return device_map
-        
+    def get_devices_pretty(self, timeout=DEFAULT):
+        return self.devices_pretty(self.usb_list(timeout))
+
+    @staticmethod
+    def devices_pretty(devices):
+        logger.debug("usb_list reply: %s", devices)
+        registry = DeviceRegistry.from_response(devices)
+        return {name: dev.to_dict() for name, dev in registry.items()}
+
+
+def resolve_future(future, result=None, error=None):
+    """Complete ``future`` unless it already expired or was cancelled."""
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        return False
+    return True
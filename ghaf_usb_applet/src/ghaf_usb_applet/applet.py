@@ -1,25 +1,50 @@
 # Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
 # SPDX-License-Identifier: Apache-2.0
 
+import time
+
 import gi
 gi.require_version("Gtk", "3.0")
 gi.require_version("AyatanaAppIndicator3", "0.1")
 from gi.repository import  AyatanaAppIndicator3 as AppIndicator3
 from gi.repository import Gtk, GLib
 
-from ghaf_usb_applet.logger import logger
-from ghaf_usb_applet.api_client import APIClient
-from ghaf_usb_applet.notification_handler import USBDeviceNotification
+from ghaf_usb_applet import metrics
+from ghaf_usb_applet.logger import log_entry_exit, logger
+from ghaf_usb_applet.api_client import CONNECTED, RECONNECTING, is_success
+from ghaf_usb_applet.async_client import AsyncAPIClient
+from ghaf_usb_applet.device_store import DeviceStore
+from ghaf_usb_applet.refresh_scheduler import RefreshScheduler, DEFAULT_DEBOUNCE_MS
+from ghaf_usb_applet.snapshot import load_snapshot, save_snapshot
 
-import threading
-import subprocess
+SNAPSHOT_DELAY = 2
 
 class USBApplet:
-    def __init__(self, port=2000):
+    def __init__(self, port=2000, refresh_debounce_ms=DEFAULT_DEBOUNCE_MS):
         self.device_map = {}
         self.radio_groups = {}
-        self.apiclient = APIClient(port=port)
-        self.apiclient.connect()
+        self.device_items = {}
+        self.settings_item = None
+        self.move_all_item = None
+        self.eject_all_item = None
+        self._bulk_vms = None
+        self._actions_enabled = None
+        self._event_received = None
+        self._pending = {}
+        self._pending_seq = 0
+        self._pending_labels = set()
+        self._error_dialog = None
+        self._error_lines = []
+        self._stale = False
+        self._snapshot_timer = None
+        self._saved_generation = None
+        self.store = DeviceStore()
+        self.port = port
+        self._chooser = None
+        self.apiclient = AsyncAPIClient(port=port)
+        self.refresher = RefreshScheduler(
+            self.apiclient.usb_list, self._on_device_list, refresh_debounce_ms
+        )
 
         self.indicator = AppIndicator3.Indicator.new(
             "usb-applet",
@@ -29,105 +54,346 @@ class USBApplet:
         self.indicator.set_status(AppIndicator3.IndicatorStatus.ACTIVE)
 
         self.menu = Gtk.Menu()
+        self.status_item = None
+        self._set_status("Connecting to USB service...")
         self.indicator.set_menu(self.menu)
-        self.refresh_device_list(async_=True)
         self.menu.show_all()
+        logger.debug("Indicator shown")
+        self._restore_snapshot()
+        self.apiclient.on_state = self._on_connection_state
+        GLib.idle_add(self._connect)
+
+    @property
+    def chooser(self):
+        if self._chooser is None:
+            from ghaf_usb_applet.chooser import ChooserClient
+            self._chooser = ChooserClient(port=self.port)
+        return self._chooser
+
+    def _connect(self):
+        self.apiclient.start()
+        return GLib.SOURCE_REMOVE
+
+    def _on_connection_state(self, state):
+        if state == CONNECTED:
+            self.store.invalidate()
+            self.refresh_device_list()
+        elif state == RECONNECTING:
+            self.store.invalidate()
+            self.refresher.cancel()
+            self._set_status("Reconnecting to USB service...")
+
+    def _restore_snapshot(self):
+        devices = load_snapshot()
+        if not devices:
+            return
+        # Shown as stale until the first live list replaces it; the normal
+        # reconcile then patches only what changed since the last session.
+        # Until then the device_nodes may belong to other devices, so the
+        # menu's actions stay insensitive.
+        self._stale = True
+        self.store.restore(devices)
+        self._saved_generation = self.store.generation
+        self._reconcile_menu(self.store.device_map())
+        self._set_status("Updating devices...")
+        logger.info("Device menu shown from snapshot")
+
+    def _schedule_snapshot(self):
+        if self._snapshot_timer is None:
+            self._snapshot_timer = GLib.timeout_add_seconds(SNAPSHOT_DELAY, self._save_snapshot)
+
+    def _save_snapshot(self):
+        self._snapshot_timer = None
+        if self.store.generation != self._saved_generation:
+            try:
+                save_snapshot(self.store.devices)
+            except OSError as e:
+                logger.warning("Failed saving device snapshot: %s", e)
+            else:
+                self._saved_generation = self.store.generation
+        return GLib.SOURCE_REMOVE
+
+    def _set_status(self, text):
+        if text is None:
+            if self.status_item is not None:
+                self.menu.remove(self.status_item)
+                self.status_item = None
+            return
+        if self.status_item is None:
+            self.status_item = Gtk.MenuItem(label=text)
+            self.status_item.set_sensitive(False)
+            self.menu.insert(self.status_item, 0)
+            self.status_item.show()
+        else:
+            self.status_item.set_label(text)
 
+    @log_entry_exit
     def on_vm_toggled(self, menuitem, devname):
-        if menuitem.get_active():
-            device_node = self.device_map[devname]['device_node']
-            vm = menuitem.get_label()
-            if vm == 'eject':
-                self.apiclient.usb_detach(device_node)
+        if not menuitem.get_active():
+            return
+        dev = self.device_map[devname]
+        vm = menuitem.get_label()
+        # The radio already shows the new VM; keep it there while the
+        # request is pending and roll back if it fails. The menu's map
+        # records what is shown, so the next render sees the revert.
+        self._pending_seq += 1
+        token = self._pending_seq
+        self._pending[dev.device_node] = (token, vm)
+        self.device_map[devname] = dev.with_vm(vm)
+        self._show_pending(devname, vm)
+
+        def _done(res, error):
+            if self._pending.get(dev.device_node, (None,))[0] != token:
                 return
-            res = self.apiclient.usb_attach(device_node, vm)
-            if (
-                res.get('event', '') == 'usb_attached'
-                or res.get('result', '') == 'ok'
-            ):
-                logger.info(f"{devname} passed to {vm}")
+            del self._pending[dev.device_node]
+            if error is None and is_success(res):
+                logger.info("%s passed to %s", devname, vm)
+                event = "usb_detached" if vm == 'eject' else "usb_attached"
+                if not self.store.apply_event(
+                    {"event": event, "usb_device": dev.to_dict(), "vm": vm}
+                ):
+                    self.refresh_device_list()
             else:
-                GLib.idle_add(self._notify_error, "Device Error", f"Message: {res}")
+                detail = error if error is not None else res.get('error', res)
+                logger.error("Failed passing %s to %s: %s", devname, vm, detail)
+                self._notify_error("Device Error", f"{devname}: {detail}")
+            self._render()
 
-    def _build_devices_submenu(self):
-        submenu = self.menu
-        self.radio_groups.clear()
-        for dev_name, dev in self.device_map.items():
-            dev_top = Gtk.MenuItem(label=dev_name)
-            devicemenu = Gtk.Menu()
-            self.radio_groups[dev_name] = dev_top
-            submenu.append(dev_top)
-            allowed_vms = dev.get('allowed_vms', [])
-            if 'eject' not in allowed_vms:
-                allowed_vms.insert(0, "eject")
-            selected = dev.get('vm', None)
-            if selected is None:
-                selected = 'eject'
-                
-            if selected not in allowed_vms:
-                allowed_vms.append(selected)
-            radio_group = None
-            self.device_map[dev_name]['allowed_vms'] = allowed_vms
-            self.device_map[dev_name]['vm'] = selected
-            for vm in allowed_vms:
-                if radio_group is None:
-                    radio_item = Gtk.RadioMenuItem.new_with_label(None, vm)
-                    radio_group = radio_item
-                else:
-                    radio_item = Gtk.RadioMenuItem.new_with_label_from_widget(radio_group, vm)
-                if vm == selected:
-                    radio_item.set_active(True)
-                radio_item.connect("toggled", self.on_vm_toggled, dev_name)
-                devicemenu.append(radio_item)
-            dev_top.set_submenu(devicemenu)
-
-        settings_item = Gtk.MenuItem(label="Settings")
-        settings_item.connect("activate", self.open_settings)
-        submenu.append(settings_item)
+        if vm == 'eject':
+            self.apiclient.usb_detach(dev.device_node, _done)
+        else:
+            self.apiclient.usb_attach(dev.device_node, vm, _done)
+
+    def _show_pending(self, dev_name, vm):
+        item = self.device_items.get(dev_name)
+        if vm is None:
+            self._pending_labels.discard(dev_name)
+            if item is not None:
+                item.set_label(dev_name)
+        elif item is not None:
+            self._pending_labels.add(dev_name)
+            item.set_label(f"{dev_name} (moving to {vm}...)")
+
+    @log_entry_exit
+    def _build_device_item(self, dev_name, dev):
+        dev_top = Gtk.MenuItem(label=dev_name)
+        dev_top.set_sensitive(not self._stale)
+        devicemenu = Gtk.Menu()
+        radio_group = None
+        radios = {}
+        for vm in dev.allowed_vms:
+            if radio_group is None:
+                radio_item = Gtk.RadioMenuItem.new_with_label(None, vm)
+                radio_group = radio_item
+            else:
+                radio_item = Gtk.RadioMenuItem.new_with_label_from_widget(radio_group, vm)
+            if vm == dev.vm:
+                radio_item.set_active(True)
+            handler = radio_item.connect("toggled", self.on_vm_toggled, dev_name)
+            radios[vm] = (radio_item, handler)
+            devicemenu.append(radio_item)
+        dev_top.set_submenu(devicemenu)
+        self.device_items[dev_name] = dev_top
+        self.radio_groups[dev_name] = radios
+        return dev_top
+
+    def _remove_device_item(self, dev_name):
+        self.menu.remove(self.device_items.pop(dev_name))
+        self.radio_groups.pop(dev_name, None)
+
+    def _select_vm(self, dev_name, vm):
+        radios = self.radio_groups[dev_name]
+        for item, handler in radios.values():
+            item.handler_block(handler)
+        try:
+            radios[vm][0].set_active(True)
+        finally:
+            for item, handler in radios.values():
+                item.handler_unblock(handler)
+
+    @log_entry_exit
+    def _reconcile_menu(self, new_map):
+        if self.status_item is not None and not self._stale:
+            self._set_status(None)
+            logger.info("Device menu populated")
+        old_map = self.device_map
+        # The status row, when shown, sits above the devices.
+        offset = 0 if self.status_item is None else 1
+        for dev_name in list(self.device_items):
+            new = new_map.get(dev_name)
+            if new is None or _menu_shape(new) != _menu_shape(old_map[dev_name]):
+                self._remove_device_item(dev_name)
+        for pos, (dev_name, dev) in enumerate(new_map.items()):
+            if dev_name not in self.device_items:
+                item = self._build_device_item(dev_name, dev)
+                self.menu.insert(item, pos + offset)
+                item.show_all()
+            elif dev.vm != old_map[dev_name].vm:
+                self._select_vm(dev_name, dev.vm)
+        self.device_map = new_map
+
+        if self.settings_item is None:
+            self.move_all_item = Gtk.MenuItem(label="Move all to")
+            self.menu.append(self.move_all_item)
+            self.eject_all_item = Gtk.MenuItem(label="Eject all")
+            self.eject_all_item.connect("activate", lambda *_: self.move_all('eject'))
+            self.menu.append(self.eject_all_item)
+            self.settings_item = Gtk.MenuItem(label="Settings")
+            self.settings_item.connect("activate", self.open_settings)
+            self.menu.append(self.settings_item)
+            self.menu.show_all()
+        self._update_move_all_menu()
+        self._update_actions()
+
+    def _update_actions(self):
+        enabled = not self._stale
+        if enabled == self._actions_enabled:
+            return
+        self._actions_enabled = enabled
+        for item in self.device_items.values():
+            item.set_sensitive(enabled)
+        self.eject_all_item.set_sensitive(enabled)
+        self.move_all_item.set_sensitive(enabled and bool(self._bulk_vms))
+
+    def _update_move_all_menu(self):
+        vms = _bulk_targets(self.device_map.values())
+        if vms == self._bulk_vms:
+            return
+        self._bulk_vms = vms
+        submenu = Gtk.Menu()
+        for vm in vms:
+            item = Gtk.MenuItem(label=vm)
+            item.connect("activate", lambda _item, vm=vm: self.move_all(vm))
+            submenu.append(item)
         submenu.show_all()
-            
+        self.move_all_item.set_submenu(submenu)
+        self.move_all_item.set_sensitive(bool(vms) and not self._stale)
+
+    @log_entry_exit
+    def move_all(self, vm):
+        assignments = [
+            (dev.device_node, vm) for dev in self.device_map.values()
+            if vm in dev.allowed_vms and dev.vm != vm
+        ]
+        if not assignments:
+            return
+
+        def _done(results, error):
+            if error is not None:
+                self._notify_error("Device Error", f"Message: {error}")
+                return
+            failed = [f"{node}: {res.get('error', res)}" for node, _vm, res in results
+                      if not is_success(res)]
+            logger.info("Moved %s of %s devices to %s",
+                        len(results) - len(failed), len(results), vm)
+            if failed:
+                self._notify_error("Device Error", "\n".join(failed))
+
+        self.apiclient.usb_attach_many(assignments, _done)
+
     def open_settings(self, *_):
-        result = subprocess.Popen(["usb_settings"])
+        import subprocess
+        subprocess.Popen(["usb_settings"])
         self.menu.popdown()
         Gtk.MenuShell.deactivate(self.menu)
 
     def clear_menu(self):
         for child in self.menu.get_children():
             self.menu.remove(child)
+        self.device_items.clear()
+        self.radio_groups.clear()
+        self.device_map = {}
+        self.settings_item = None
+        self.move_all_item = None
+        self.eject_all_item = None
+        self._bulk_vms = None
+        self._actions_enabled = None
 
-    def refresh_device_list(self, async_=True):
-        def _fetch_and_update():
-            try:
-                devs = self.apiclient.get_devices_pretty()
-            except Exception as e:
-                logger.exception("Failed fetching devices")
-                self._error("Server Error", f"Device fetch failed: {e}")
-                return
+    @log_entry_exit
+    def on_device_event(self, msg):
+        # Called synchronously from notify_user; the latency covers both
+        # the delta path and a fallback refresh.
+        if metrics.ENABLED and self._event_received is None:
+            self._event_received = time.perf_counter()
+        if self.store.apply_event(msg):
+            logger.debug("Applied %s, generation %s", msg.get("event"), self.store.generation)
+            self.refresher.mark_stale()
+            self._render()
+        else:
+            self.refresh_device_list()
 
-            def _apply():
-                self.clear_menu()
-                self.device_map = devs or {}
-                self.radio_groups.clear()
-                self._build_devices_submenu()
-                return GLib.SOURCE_REMOVE
-            GLib.idle_add(_apply)
+    def on_notifications_connected(self):
+        self.store.invalidate()
+        self.refresh_device_list()
 
-        if async_:
-            threading.Thread(target=_fetch_and_update, daemon=True).start()
-        else:
-            _fetch_and_update()
+    def refresh_device_list(self, *_):
+        if self.apiclient.state != CONNECTED:
+            return
+        self.refresher.request()
+
+    @log_entry_exit
+    def _on_device_list(self, res, error):
+        if error is not None:
+            logger.error("Failed fetching devices: %s", error)
+            self._notify_error("Server Error", f"Device fetch failed: {error}")
+            return
+        if self.store.replace(res):
+            self._stale = False
+            self._render()
+        logger.debug("Refresh stats: %s", self.refresher.stats())
+
+    def _render(self):
+        # Devices with a request in flight keep showing their target VM
+        # until the reply or the matching event settles them.
+        device_map = self.store.device_map()
+        for name, dev in device_map.items():
+            pending = self._pending.get(dev.device_node)
+            if pending is not None:
+                if dev.vm == pending[1]:
+                    del self._pending[dev.device_node]
+                else:
+                    device_map[name] = dev.with_vm(pending[1])
+        self._reconcile_menu(device_map)
+        if not self._stale:
+            self._schedule_snapshot()
+        for name in list(self._pending_labels):
+            dev = device_map.get(name)
+            if dev is None or dev.device_node not in self._pending:
+                self._show_pending(name, None)
+        for node, (_token, vm) in self._pending.items():
+            name = self.store.devices.display_name(node)
+            if name is not None:
+                self._show_pending(name, vm)
+        if self._event_received is not None:
+            metrics.observe(
+                "ghaf_usb_event_to_ui_seconds", time.perf_counter() - self._event_received
+            )
+            self._event_received = None
 
     def _notify_error(self, title: str, msg: str) -> None:
+        # Non-modal: never spin a nested main loop from the tray. Errors
+        # arriving while the dialog is open are appended to it.
+        if self._error_dialog is not None:
+            self._error_lines.append(msg)
+            self._error_dialog.format_secondary_text("\n".join(self._error_lines[-10:]))
+            return
         dialog = Gtk.MessageDialog(
             parent=None,
-            flags=Gtk.DialogFlags.MODAL,
+            flags=0,
             type=Gtk.MessageType.ERROR,
             buttons=Gtk.ButtonsType.OK,
             message_format=title,
         )
         dialog.format_secondary_text(msg)
-        dialog.run()
+        dialog.connect("response", self._on_error_response)
+        self._error_dialog = dialog
+        self._error_lines = [msg]
+        dialog.show()
+
+    def _on_error_response(self, dialog, _response):
         dialog.destroy()
+        self._error_dialog = None
+        self._error_lines = []
 
     def refresh_device(self, widget):
         l = widget.get_label()
@@ -137,31 +403,37 @@ class USBApplet:
         if dev is None:
             GLib.idle_add(self._notify_error, "Device Error", "Not able to access device")
             return
-        if len(dev.get('allowed_vms',[])) < 2:
+        if len(dev.allowed_vms) < 2:
             self._notify_error("Device Error", "Operation not permitted")
             return
         
-        cmd = [
-            "usb_device",
-            "--title", "Device Setting",
-            "--device_node", dev.get('device_node', ''),
-            "--product_name", name,
-            "--allowed_vms", *dev.get('allowed_vms', ''),
-        ]
+        self.chooser.show(dict(dev.to_dict(), product_name=name), "Device Setting")
+
+def _bulk_targets(devices):
+    vms = []
+    for dev in devices:
+        for vm in dev.allowed_vms:
+            if vm != 'eject' and vm not in vms:
+                vms.append(vm)
+    return tuple(vms)
 
-        selected = dev.get('vm', None)
-        if selected:
-            cmd = cmd + ["--vm", selected]
 
-        logger.debug(cmd)
-        result = subprocess.Popen(cmd)
+def _menu_shape(dev):
+    return dev.device_node, dev.allowed_vms
 
 _app_instance = None
 
 def start_usb_applet(port=2000):
     global _app_instance
     applet = USBApplet(port=port)
-    notif = USBDeviceNotification(server_port=port)
-    th = notif.monitor(applet.refresh_device_list)
+
+    def _monitor():
+        from ghaf_usb_applet.notification_handler import USBDeviceNotification
+        notif = USBDeviceNotification(
+            server_port=port, chooser=applet.chooser, apiclient=applet.apiclient,
+        )
+        notif.monitor(applet.on_device_event, applet.on_notifications_connected)
+        return GLib.SOURCE_REMOVE
+
+    GLib.idle_add(_monitor)
     Gtk.main()
-    th.join()
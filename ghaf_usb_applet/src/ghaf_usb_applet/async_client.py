@@ -0,0 +1,395 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+import errno
+import socket
+import time
+from concurrent.futures import Future
+
+from gi.repository import GLib
+
+from ghaf_usb_applet import metrics
+from ghaf_usb_applet.api_client import (
+    APIClient, APITimeout, Backoff, CONNECTED, CONNECTING, DEFAULT,
+    RECONNECTING, batch_result, resolve_future,
+)
+from ghaf_usb_applet.devices import EJECT
+from ghaf_usb_applet.event_queue import BLOCK, DEFAULT_QUEUE_SIZE, DROP_OLDEST, EventQueue
+from ghaf_usb_applet.framing import FrameTooLarge
+from ghaf_usb_applet.logger import log_entry_exit, logger
+
+# Health probe for an idle connection. The API has no ping action; any
+# reply, including the error for an unknown action, shows the host is
+# alive, and unlike usb_list it costs the host no device enumeration.
+PROBE_REQUEST = {"action": "ping"}
+
+
+class AsyncAPIClient(APIClient):
+    """APIClient driven by the GLib main loop.
+
+    Replies are read from an io watch on the socket fd instead of a reader
+    thread, so every future and callback completes on the main loop.
+    Request methods never block; they return a Future and optionally call
+    ``callback(result, error)`` once the reply arrives or the request's
+    deadline passes (``error`` is then an ``APITimeout``). Cancelling the
+    returned Future suppresses the callback.
+
+    After ``start()`` the connection is managed: it is re-dialled with
+    exponential backoff when lost, requests made while it is down wait for
+    the next connection, and a connection that has received nothing for
+    ``keepalive`` seconds is probed with PROBE_REQUEST.
+    """
+
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, port=2000, cid=2, transport=None, keepalive=30, probe_timeout=10,
+                 timeout=DEFAULT):
+        super().__init__(port=port, cid=cid, transport=transport, timeout=timeout)
+        self.keepalive = keepalive
+        self.probe_timeout = probe_timeout
+        self._watch_id = None
+        self._connect_watch = None
+        self._dialing = False
+        self._dial_timer = None
+        self._keepalive_timer = None
+        self._waiting = []
+        self._last_rx = 0.0
+
+    def start(self):
+        self.auto_reconnect = True
+        self._stopped = False
+        self._dial()
+
+    def _dial(self):
+        self._dial_timer = None
+        if self._dialing or self.sock is not None or self._stopped:
+            return GLib.SOURCE_REMOVE
+        self._dialing = True
+        if self.state != RECONNECTING:
+            self._set_state(CONNECTING)
+        self.connect_async(self._on_dialled)
+        return GLib.SOURCE_REMOVE
+
+    def _on_dialled(self, error):
+        self._dialing = False
+        if error is None:
+            waiting, self._waiting = self._waiting, []
+            for msg, future in waiting:
+                if not future.done():
+                    _forward(self._send_request(msg), future)
+            return
+        self._dial_failed()
+        self._set_state(RECONNECTING)
+        metrics.inc("ghaf_usb_api_dial_failures_total", client=self.name)
+        waiting, self._waiting = self._waiting, []
+        for _msg, future in waiting:
+            resolve_future(future, error=ConnectionError(f"API connection unavailable: {error}"))
+        self._schedule_dial(error)
+
+    def _schedule_dial(self, reason):
+        if self._stopped or self._dial_timer is not None:
+            return
+        delay = self.backoff.next_delay()
+        logger.warning("API connection lost (%s), reconnecting in %.1f sec", reason, delay)
+        self._dial_timer = GLib.timeout_add(int(delay * 1000), self._dial)
+
+    def connect_async(self, callback):
+        try:
+            sock, address = self._create_socket()
+        except OSError as e:
+            callback(e)
+            return
+        sock.setblocking(False)
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EAGAIN):
+            sock.close()
+            callback(OSError(err, f"Connect failed: {errno.errorcode.get(err, err)}"))
+            return
+
+        def _writable(*_):
+            self._connect_watch = None
+            if self._stopped:
+                sock.close()
+                return GLib.SOURCE_REMOVE
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                sock.close()
+                callback(OSError(err, f"Connect failed: {errno.errorcode.get(err, err)}"))
+                return GLib.SOURCE_REMOVE
+            sock.setblocking(True)
+            self._connected(sock)
+            callback(None)
+            return GLib.SOURCE_REMOVE
+
+        self._connect_watch = GLib.io_add_watch(
+            sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_OUT | GLib.IO_HUP | GLib.IO_ERR,
+            _writable,
+        )
+
+    def _connected(self, sock):
+        self._last_rx = time.monotonic()
+        super()._connected(sock)
+        if self.keepalive and self.auto_reconnect:
+            self._keepalive_timer = GLib.timeout_add_seconds(self.keepalive, self._probe)
+
+    def _probe(self):
+        if self.sock is None:
+            self._keepalive_timer = None
+            return GLib.SOURCE_REMOVE
+        if time.monotonic() - self._last_rx < self.keepalive:
+            return GLib.SOURCE_CONTINUE
+        sock = self.sock
+
+        def _answered(future):
+            if isinstance(future.exception(), APITimeout) and self.sock is sock:
+                logger.warning("API health probe timed out")
+                self._connection_lost("health probe timeout")
+
+        self.submit(PROBE_REQUEST, self.probe_timeout).add_done_callback(_answered)
+        return GLib.SOURCE_CONTINUE
+
+    @log_entry_exit
+    def submit(self, msg, timeout=DEFAULT):
+        if self.sock is None and self.auto_reconnect and not self._stopped:
+            future = Future()
+            self._waiting.append((msg, future))
+            self._arm_deadline(future, self._timeout(timeout))
+            self._track(future, msg)
+            if self._dial_timer is not None:
+                GLib.source_remove(self._dial_timer)
+                self._dial_timer = None
+            self._dial()
+            return future
+        return super().submit(msg, timeout)
+
+    def _arm_deadline(self, future, timeout):
+        if timeout is None or future.done():
+            return
+        timer = None
+
+        def _expired():
+            nonlocal timer
+            timer = None
+            self._expire(future, timeout)
+            return GLib.SOURCE_REMOVE
+
+        def _settled(_future):
+            if timer is not None:
+                GLib.source_remove(timer)
+
+        timer = GLib.timeout_add(int(timeout * 1000), _expired)
+        future.add_done_callback(_settled)
+
+    def _start_reader(self, sock):
+        self._watch_id = GLib.io_add_watch(
+            sock.fileno(),
+            GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self._on_readable,
+            sock,
+        )
+
+    @log_entry_exit
+    def _on_readable(self, _fd, condition, sock):
+        if sock is not self.sock:
+            return GLib.SOURCE_REMOVE
+        received = 0
+        if condition & GLib.IO_IN:
+            try:
+                received = self._decoder.recv_into(sock)
+                if received:
+                    self._last_rx = time.monotonic()
+                    self._dispatch_frames()
+                    return GLib.SOURCE_CONTINUE
+                logger.info("API connection closed by remote")
+            except FrameTooLarge as e:
+                logger.error("API protocol error: %s", e)
+            except OSError as e:
+                logger.warning("API connection error: %s", e)
+        self._watch_id = None
+        self._connection_lost("closed by remote")
+        return GLib.SOURCE_REMOVE
+
+    def _remove_sources(self):
+        for attr in ("_watch_id", "_keepalive_timer"):
+            source = getattr(self, attr)
+            if source is not None:
+                GLib.source_remove(source)
+                setattr(self, attr, None)
+
+    def _connection_lost(self, reason):
+        self._remove_sources()
+        self._drop_connection()
+        if self.auto_reconnect:
+            self._schedule_dial(reason)
+
+    def close(self):
+        self._remove_sources()
+        if self._dial_timer is not None:
+            GLib.source_remove(self._dial_timer)
+            self._dial_timer = None
+        # A dial still in progress must not bring the client back.
+        if self._connect_watch is not None:
+            GLib.source_remove(self._connect_watch)
+            self._connect_watch = None
+        self._dialing = False
+        super().close()
+        waiting, self._waiting = self._waiting, []
+        for _msg, future in waiting:
+            resolve_future(future, error=ConnectionError("API connection closed"))
+
+    def send(self, msg, callback=None, timeout=DEFAULT):
+        future = self.submit(msg, timeout)
+        if callback is not None:
+            future.add_done_callback(lambda f: _complete(f, callback))
+        return future
+
+    def enable_notifications(self, callback=None, timeout=DEFAULT):
+        def _check(response, error):
+            if error is None and response.get("result") != "ok":
+                logger.error("Failed to enable notifications: %s", response)
+            if callback is not None:
+                callback(response, error)
+
+        return self.send({"action": "enable_notifications"}, _check, timeout)
+
+    @log_entry_exit
+    def usb_list(self, callback=None, timeout=DEFAULT):
+        return self.send({"action": "usb_list"}, callback, timeout)
+
+    @log_entry_exit
+    def usb_attach(self, device_node, vm, callback=None, timeout=DEFAULT):
+        return self.send(
+            {"action": "usb_attach", "device_node": device_node, "vm": vm}, callback, timeout
+        )
+
+    @log_entry_exit
+    def usb_detach(self, device_node, callback=None, timeout=DEFAULT):
+        return self.send(
+            {"action": "usb_detach", "device_node": device_node}, callback, timeout
+        )
+
+    @log_entry_exit
+    def usb_attach_many(self, assignments, callback=None, timeout=DEFAULT):
+        submitted = self.submit_many(assignments, timeout)
+        remaining = [len(submitted)]
+        done = Future()
+
+        def _one_done(_future):
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                resolve_future(done, [(n, vm, batch_result(f)) for n, vm, f in submitted])
+
+        if not submitted:
+            done.set_result([])
+        for _node, _vm, future in submitted:
+            future.add_done_callback(_one_done)
+        if callback is not None:
+            done.add_done_callback(lambda f: _complete(f, callback))
+        return done
+
+    def usb_detach_many(self, device_nodes, callback=None, timeout=DEFAULT):
+        return self.usb_attach_many(
+            ((node, EJECT) for node in device_nodes), callback, timeout
+        )
+
+    def get_devices_pretty(self, callback, timeout=DEFAULT):
+        def _convert(response, error):
+            if error is not None:
+                callback(None, error)
+                return
+            callback(self.devices_pretty(response), None)
+
+        return self.usb_list(_convert, timeout)
+
+    # pylint: disable=too-many-positional-arguments,too-many-arguments
+    @classmethod
+    def recv_notifications(
+        cls, callback, port=2000, cid=2, reconnect_delay=3, on_connected=None,
+        transport=None, queue_size=DEFAULT_QUEUE_SIZE, overflow=DROP_OLDEST,
+    ):
+        client = cls(port=port, cid=cid, transport=transport, keepalive=0)
+        client.name = "notifications"
+        client.dispatcher = MainLoopDispatcher(callback, queue_size, overflow, client.name)
+        client.on_event = client.dispatcher
+        client.backoff = Backoff(initial=reconnect_delay)
+
+        def _enabled(response, error):
+            if error is None and response.get("result") == "ok" and on_connected:
+                on_connected()
+
+        def _state(state):
+            if state == CONNECTED:
+                client.enable_notifications(_enabled)
+
+        client.on_state = _state
+        client.start()
+        return client
+
+
+class MainLoopDispatcher:
+    """Queues events from the io watch and hands them to ``handler`` from
+    an idle source, ``batch`` per main loop iteration, so a slow handler
+    does not hold back reading the socket.
+
+    The main loop cannot wait for room, so with the BLOCK policy a full
+    queue is drained by handling its oldest event inline, which holds back
+    reading instead of dropping anything.
+    """
+
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, handler, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST,
+                 name="notifications", batch=32):
+        self.handler = handler
+        self.queue = EventQueue(maxsize, policy, name)
+        self.batch = batch
+        self._idle = None
+
+    def __call__(self, msg):
+        while not self.queue.put(msg, block=False) and self.queue.policy == BLOCK:
+            oldest = self.queue.get_nowait()
+            if oldest is None:
+                return
+            self._handle(oldest)
+        if self._idle is None and len(self.queue):
+            self._idle = GLib.idle_add(self._drain)
+
+    def _handle(self, msg):
+        try:
+            self.handler(msg)
+        except Exception:
+            logger.exception("API event handler failed")
+
+    def _drain(self):
+        for _ in range(self.batch):
+            msg = self.queue.get_nowait()
+            if msg is None:
+                self._idle = None
+                return GLib.SOURCE_REMOVE
+            self._handle(msg)
+        return GLib.SOURCE_CONTINUE
+
+    def close(self):
+        self.queue.close()
+        if self._idle is not None:
+            GLib.source_remove(self._idle)
+            self._idle = None
+
+
+def _forward(source, target):
+    def _done(f):
+        if f.cancelled():
+            return
+        error = f.exception()
+        if error is not None:
+            resolve_future(target, error=error)
+        else:
+            resolve_future(target, f.result())
+    source.add_done_callback(_done)
+    target.add_done_callback(lambda t: source.cancel() if t.cancelled() else None)
+
+
+def _complete(future, callback):
+    if future.cancelled():
+        return
+    error = future.exception()
+    callback(None if error else future.result(), error)
@@ -0,0 +1,391 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Per-session broker in front of the vHotplug API. It holds the only
+# upstream request connection and notification subscription, keeps the
+# device list current from hotplug events and serves the same
+# newline-delimited JSON protocol on a Unix socket in $XDG_RUNTIME_DIR.
+# APIClient dials that socket automatically when it exists, so usb_list
+# is answered from the cache and every UI shares one host connection.
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+from ghaf_usb_applet import metrics
+from ghaf_usb_applet.api_client import (
+    CONNECTED, CONNECTING, DEFAULT, RECONNECTING, TRANSPORT_ENV, APIClient,
+    batch_result, broker_path, is_success,
+)
+from ghaf_usb_applet.device_store import RESYNC_INTERVAL
+from ghaf_usb_applet.event_queue import OVERFLOW_EVENT
+from ghaf_usb_applet.logger import log_entry_exit, logger
+
+# Messages queued for one local client before it is considered stuck and
+# disconnected.
+OUTBOUND_QUEUE = 1024
+WRITER_LINGER = 1.0
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Replies and events are written by a per-connection thread from a
+    # bounded queue, so a client that stops reading never blocks the
+    # upstream reader or the notification fan-out; it is disconnected
+    # once its queue fills up.
+
+    def setup(self):
+        super().setup()
+        self.outbound = queue.Queue(OUTBOUND_QUEUE)
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+        self.server.broker.track(self)
+
+    def write(self, msg):
+        """Queue ``msg``; False once the connection is closing."""
+        if self.closed:
+            return False
+        data = (json.dumps(msg) + "\n").encode("utf-8")
+        try:
+            self.outbound.put_nowait(data)
+        except queue.Full:
+            logger.warning("Broker client is not reading, disconnecting it")
+            metrics.inc("ghaf_usb_broker_slow_clients_total")
+            self._drop()
+            return False
+        return True
+
+    def _drop(self):
+        self.closed = True
+        _shutdown(self.request)
+
+    def _write_loop(self):
+        while True:
+            data = self.outbound.get()
+            if data is None:
+                return
+            try:
+                self.wfile.write(data)
+            except OSError:
+                self._drop()
+                return
+
+    def reply(self, request, msg):
+        if "id" in request:
+            msg = dict(msg, id=request["id"])
+        self.write(msg)
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            for line in self.rfile:
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    self.write({"result": "failed", "error": "invalid json"})
+                    continue
+                if isinstance(msg, dict):
+                    broker.handle(msg, self)
+                else:
+                    self.write({"result": "failed", "error": "invalid request"})
+        except OSError:
+            pass
+        finally:
+            broker.unsubscribe(self)
+            broker.untrack(self)
+
+    def finish(self):
+        # Let the writer flush what is queued, but not wait on a stuck client.
+        if not self.closed:
+            self.closed = True
+            try:
+                self.outbound.put_nowait(None)
+            except queue.Full:
+                self._drop()
+        self.writer.join(WRITER_LINGER)
+        if self.writer.is_alive():
+            self._drop()
+        super().finish()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Broker:
+    """Shares one vHotplug connection and device cache between local clients.
+
+    ``usb_list`` is served from the cache while it is fresh; other actions
+    are forwarded upstream and answered when the host replies. Clients that
+    enable notifications get every upstream event. When the upstream
+    notification connection drops the cache is invalidated and subscribers
+    are disconnected, so they reconnect and re-read the device list.
+    """
+
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, path=None, port=2000, cid=2, upstream=None, timeout=DEFAULT,
+                 resync_interval=RESYNC_INTERVAL):
+        self.path = path or broker_path()
+        if not self.path:
+            raise ValueError("No broker socket path: set XDG_RUNTIME_DIR")
+        self.port = port
+        self.cid = cid
+        self.upstream = upstream or os.environ.get(TRANSPORT_ENV) or "vsock"
+        if self.upstream == f"unix:{self.path}":
+            raise ValueError("Broker upstream cannot be the broker socket itself")
+        self.resync_interval = resync_interval
+        self.client = APIClient(port, cid, self.upstream, timeout)
+        self.client.name = "broker"
+        self.client.auto_reconnect = True
+        self.notifier = None
+        self._notifier_lost = False
+        self.devices = {}
+        self.last_sync = None
+        self._lock = threading.Lock()
+        self._list_lock = threading.Lock()
+        self._fetching = False
+        self._backlog = []
+        self._subscribers = []
+        self._connections = set()
+        self._server = None
+        self._thread = None
+
+    def handle(self, msg, conn):
+        action = msg.get("action")
+        if action == "usb_list":
+            conn.reply(msg, self.usb_list())
+        elif action == "enable_notifications":
+            self.subscribe(conn)
+            conn.reply(msg, {"result": "ok"})
+        else:
+            self.forward(msg, conn)
+
+    def forward(self, msg, conn):
+        request = {k: v for k, v in msg.items() if k != "id"}
+        future = self.client.submit(request)
+
+        def _done(f):
+            reply = batch_result(f)
+            if is_success(reply) and request.get("action") in ("usb_attach", "usb_detach"):
+                self._apply_reply(request)
+            conn.reply(msg, reply)
+
+        future.add_done_callback(_done)
+
+    def _apply_reply(self, request):
+        # The host confirms with an event as well; updating now keeps a
+        # usb_list that arrives before that event consistent with the reply.
+        if request["action"] == "usb_attach":
+            event = {"event": "usb_attached", "vm": request.get("vm")}
+        else:
+            event = {"event": "usb_detached"}
+        event["usb_device"] = {"device_node": request.get("device_node")}
+        with self._lock:
+            self._apply_locked(event)
+
+    def _fresh(self):
+        return (
+            self.last_sync is not None
+            and time.monotonic() - self.last_sync <= self.resync_interval
+        )
+
+    @log_entry_exit
+    def usb_list(self):
+        with self._lock:
+            if self._fresh():
+                metrics.inc("ghaf_usb_broker_list_total", result="cached")
+                return self._list_reply()
+        # One upstream fetch at a time; concurrent callers reuse its result.
+        with self._list_lock:
+            with self._lock:
+                if self._fresh():
+                    metrics.inc("ghaf_usb_broker_list_total", result="cached")
+                    return self._list_reply()
+                self._fetching = True
+            response = batch_result(self.client.submit({"action": "usb_list"}))
+            metrics.inc("ghaf_usb_broker_list_total", result="fetched")
+            with self._lock:
+                self._fetching = False
+                backlog, self._backlog = self._backlog, []
+                if response.get("result") != "ok":
+                    logger.error("Upstream device list request failed: %s", response)
+                    return response
+                self.devices = {
+                    dev["device_node"]: dev
+                    for dev in response.get("usb_devices", [])
+                    if isinstance(dev, dict) and dev.get("device_node")
+                }
+                self.last_sync = time.monotonic()
+                # Events that arrived while the list was in flight may be
+                # newer than it.
+                for event in backlog:
+                    self._apply_locked(event)
+                return self._list_reply()
+
+    def _list_reply(self):
+        return {"result": "ok", "usb_devices": [dict(d) for d in self.devices.values()]}
+
+    def invalidate(self):
+        with self._lock:
+            self.last_sync = None
+
+    def _apply_locked(self, msg):
+        event = msg.get("event")
+        if event == OVERFLOW_EVENT:
+            self.last_sync = None
+            return
+        dev = msg.get("usb_device") or {}
+        node = dev.get("device_node") or msg.get("device_node")
+        if not node:
+            return
+        known = self.devices.get(node)
+        if event == "usb_connected":
+            self.devices[node] = dict(dev)
+        elif event == "usb_disconnected":
+            self.devices.pop(node, None)
+        elif event == "usb_attached":
+            vm = msg.get("vm", dev.get("vm"))
+            if known is not None:
+                self.devices[node] = dict(known, vm=vm)
+            elif dev.get("allowed_vms"):
+                self.devices[node] = dict(dev, vm=vm)
+            else:
+                self.last_sync = None
+        elif event == "usb_detached":
+            if known is not None:
+                self.devices[node] = dict(known, vm=None)
+            else:
+                self.last_sync = None
+
+    @log_entry_exit
+    def on_event(self, msg):
+        with self._lock:
+            self._apply_locked(msg)
+            if self._fetching:
+                self._backlog.append(msg)
+            subscribers = list(self._subscribers)
+        for conn in subscribers:
+            if not conn.write(msg):
+                self.unsubscribe(conn)
+
+    def _on_notifier_state(self, state):
+        # Subscribers are disconnected when the upstream subscription drops
+        # and again once it is back, so whoever re-subscribed during the gap
+        # re-reads the device list it may have missed events for.
+        if state in (CONNECTED, CONNECTING, RECONNECTING):
+            return
+        self._notifier_lost = True
+        self._resync_subscribers(f"notifications {state}")
+
+    def _on_notifier_subscribed(self):
+        # Only once the host has acknowledged enable_notifications are
+        # events flowing again; resyncing on connect would let clients
+        # re-read the list before events they then miss.
+        if self._notifier_lost:
+            self._notifier_lost = False
+            self._resync_subscribers("notifications resubscribed")
+
+    def _resync_subscribers(self, reason):
+        logger.info("Upstream %s, resyncing clients", reason)
+        self.invalidate()
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+        for conn in subscribers:
+            _shutdown(conn.request)
+
+    def subscribe(self, conn):
+        with self._lock:
+            if conn not in self._subscribers:
+                self._subscribers.append(conn)
+
+    def unsubscribe(self, conn):
+        with self._lock:
+            if conn in self._subscribers:
+                self._subscribers.remove(conn)
+
+    def track(self, conn):
+        with self._lock:
+            self._connections.add(conn)
+            metrics.set_gauge("ghaf_usb_broker_clients", len(self._connections))
+
+    def untrack(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+            metrics.set_gauge("ghaf_usb_broker_clients", len(self._connections))
+
+    def start(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.unlink(self.path)
+            else:
+                raise RuntimeError(f"A USB broker is already listening on {self.path}")
+            finally:
+                probe.close()
+        self._server = _UnixServer(self.path, _Handler)
+        os.chmod(self.path, 0o600)
+        self._server.broker = self
+        try:
+            self.client.connect()
+        except OSError as e:
+            logger.warning("Upstream connection failed: %s, retrying on demand", e)
+        _thread, self.notifier = APIClient.recv_notifications(
+            self.on_event, port=self.port, cid=self.cid, transport=self.upstream,
+            on_connected=self._on_notifier_subscribed,
+        )
+        self.notifier.on_state = self._on_notifier_state
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        threading.Thread(target=self.usb_list, daemon=True).start()
+        logger.info("USB broker listening on %s, upstream %s", self.path, self.upstream)
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._server = None
+            with self._lock:
+                connections = list(self._connections)
+            for conn in connections:
+                _shutdown(conn.request)
+        if self.notifier is not None:
+            self.notifier.close()
+            self.notifier = None
+        self.client.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def run_broker(path=None, port=2000, upstream=None):
+    broker = Broker(path, port=port, upstream=upstream)
+    with broker:
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+metrics.describe("ghaf_usb_broker_clients", "Local clients connected to the USB broker")
+metrics.describe("ghaf_usb_broker_list_total", "usb_list requests served by the broker by source")
+metrics.describe("ghaf_usb_broker_slow_clients_total",
+                 "Local clients disconnected for not reading their replies")
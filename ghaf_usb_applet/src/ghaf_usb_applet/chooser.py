@@ -0,0 +1,155 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import os
+import socket
+import stat
+import subprocess
+import time
+
+from gi.repository import GLib
+
+from ghaf_usb_applet.logger import logger
+
+CHOOSER_SOCKET = "ghaf-usb-chooser.sock"
+SPAWN_TIMEOUT = 5.0
+
+
+def chooser_socket_path():
+    """Chooser socket in $XDG_RUNTIME_DIR, else in a private /tmp directory.
+
+    Raises PermissionError if the /tmp directory is not a 0700 directory
+    owned by the current user, since anyone could have created it.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        runtime_dir = f"/tmp/ghaf-usb-{os.getuid()}"
+        _private_dir(runtime_dir)
+    return os.path.join(runtime_dir, CHOOSER_SOCKET)
+
+
+def _private_dir(path):
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f"{path} is not a private directory of this user")
+
+
+def bind_chooser_socket(path=None):
+    """Listen on the chooser socket; RuntimeError if a service already does."""
+    path = path or chooser_socket_path()
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            raise RuntimeError(f"A device chooser is already listening on {path}")
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    return server
+
+
+def encode_request(device, title):
+    return (json.dumps({"title": title, "device": device}) + "\n").encode("utf-8")
+
+
+def decode_request(line):
+    request = json.loads(line)
+    if not isinstance(request, dict) or not isinstance(request.get("device"), dict):
+        raise ValueError("device missing from chooser request")
+    return request
+
+
+def device_command(device, title, port=2000):
+    cmd = [
+        "usb_device",
+        "--title", title,
+        "--port", str(port),
+        "--device_node", device.get('device_node', ''),
+        "--product_name", device.get('product_name', ''),
+        "--allowed_vms", *device.get('allowed_vms', ''),
+    ]
+    selected = device.get('vm', None)
+    if selected:
+        cmd = cmd + ["--vm", selected]
+    return cmd
+
+
+class ChooserClient:
+    """Sends device chooser requests to the resident ``usb_device --serve``.
+
+    The service is spawned on first use; requests made while it starts are
+    queued. If it does not come up in time the old one-process-per-prompt
+    path is used instead.
+    """
+
+    def __init__(self, port=2000, path=None, spawn_timeout=SPAWN_TIMEOUT):
+        self.port = port
+        if path is None:
+            try:
+                path = chooser_socket_path()
+            except OSError as e:
+                logger.warning("Not using the device chooser service: %s", e)
+        self.path = path
+        self.spawn_timeout = spawn_timeout
+        self.sock = None
+        self._queue = []
+        self._deadline = None
+
+    def show(self, device, title):
+        if self.path is None:
+            subprocess.Popen(device_command(device, title, self.port))
+            return
+        if not self._queue and self._send(encode_request(device, title)):
+            return
+        self._queue.append((device, title))
+        if self._deadline is None:
+            self._spawn()
+
+    def _send(self, data):
+        if self.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                return False
+            self.sock = sock
+        try:
+            self.sock.sendall(data)
+            return True
+        except OSError as e:
+            logger.warning("Device chooser connection lost: %s", e)
+            self.sock.close()
+            self.sock = None
+            return False
+
+    def _spawn(self):
+        logger.info("Starting device chooser service")
+        subprocess.Popen(["usb_device", "--serve", "--port", str(self.port)])
+        self._deadline = time.monotonic() + self.spawn_timeout
+        GLib.timeout_add(50, self._flush)
+
+    def _flush(self):
+        while self._queue and self._send(encode_request(*self._queue[0])):
+            self._queue.pop(0)
+        if not self._queue:
+            self._deadline = None
+            return GLib.SOURCE_REMOVE
+        if time.monotonic() < self._deadline:
+            return GLib.SOURCE_CONTINUE
+        logger.error("Device chooser service did not start, spawning windows directly")
+        for device, title in self._queue:
+            subprocess.Popen(device_command(device, title, self.port))
+        self._queue.clear()
+        self._deadline = None
+        return GLib.SOURCE_REMOVE
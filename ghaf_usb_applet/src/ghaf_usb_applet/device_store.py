@@ -0,0 +1,88 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+import time
+
+from ghaf_usb_applet.devices import DeviceRegistry, USBDevice, parse_usb_list
+from ghaf_usb_applet.logger import log_entry_exit, logger
+
+RESYNC_INTERVAL = 300
+
+
+class DeviceStore:
+    """Device state keyed by device_node, kept current from notifications.
+
+    Full ``usb_list`` replies are loaded with ``replace()``; hotplug events
+    are applied as deltas with ``apply_event()``. ``apply_event()`` returns
+    False when the event cannot be applied safely (unknown device, unknown
+    event) and the caller should reconcile against a fresh ``usb_list``.
+    """
+
+    def __init__(self, resync_interval=RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self.devices = DeviceRegistry()
+        self.generation = 0
+        self.last_sync = None
+
+    @log_entry_exit
+    def replace(self, response):
+        if response.get("result") != "ok":
+            logger.error("Device list request failed: %s", response)
+            return False
+        self.devices.replace(parse_usb_list(response))
+        self.last_sync = time.monotonic()
+        self.generation += 1
+        return True
+
+    def restore(self, devices):
+        """Load devices from a snapshot; the store stays due for a resync."""
+        self.devices.replace(devices)
+        self.last_sync = None
+        self.generation += 1
+
+    def invalidate(self):
+        self.last_sync = None
+
+    def needs_resync(self):
+        if self.last_sync is None:
+            return True
+        return time.monotonic() - self.last_sync > self.resync_interval
+
+    @log_entry_exit
+    def apply_event(self, msg):
+        if self.needs_resync():
+            return False
+        event = msg.get("event", "")
+        dev = msg.get("usb_device") or {}
+        node = dev.get("device_node") or msg.get("device_node")
+        if not node:
+            return False
+        known = self.devices.get(node)
+
+        if event == "usb_disconnected":
+            self.devices.remove(node)
+        elif event == "usb_connected":
+            device = USBDevice.from_wire(dev)
+            if device is None:
+                self.devices.remove(node)
+            else:
+                self.devices.upsert(device)
+        elif event == "usb_attached":
+            vm = msg.get("vm", dev.get("vm"))
+            if known is None:
+                known = USBDevice.from_wire(dev)
+                if known is None:
+                    return False
+            self.devices.upsert(known.with_vm(vm))
+        elif event == "usb_detached":
+            if known is None:
+                return False
+            self.devices.upsert(known.with_vm(None))
+        else:
+            return False
+
+        self.generation += 1
+        return True
+
+    def device_map(self):
+        return self.devices.device_map()
@@ -0,0 +1,178 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+EJECT = "eject"
+UNKNOWN_DEVICE = "<unknown device>"
+
+
+class USBDevice:
+    """Immutable, normalized view of one device from the vHotplug API."""
+
+    __slots__ = (
+        "device_node", "product_name", "vendor_id", "product_id",
+        "serial", "port_path", "allowed_vms", "vm",
+    )
+
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, device_node, product_name, allowed_vms, vm=EJECT,
+                 vendor_id=None, product_id=None, serial=None, port_path=None):
+        setter = object.__setattr__
+        setter(self, "device_node", device_node)
+        setter(self, "product_name", product_name)
+        setter(self, "allowed_vms", tuple(allowed_vms))
+        setter(self, "vm", vm)
+        setter(self, "vendor_id", vendor_id)
+        setter(self, "product_id", product_id)
+        setter(self, "serial", serial)
+        setter(self, "port_path", port_path)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __eq__(self, other):
+        if not isinstance(other, USBDevice):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def __hash__(self):
+        return hash((self.device_node, self.vm, self.allowed_vms))
+
+    def __repr__(self):
+        return f"USBDevice({self.device_node!r}, {self.product_name!r}, vm={self.vm!r})"
+
+    @classmethod
+    def from_wire(cls, dev, allowed_vms=None):
+        node = dev.get("device_node")
+        name = dev.get("product_name")
+        allowed = list(allowed_vms or dev.get("allowed_vms") or [])
+        if not node or name is None or not allowed:
+            return None
+        name = UNKNOWN_DEVICE if name.isdigit() else name.replace("_", " ")
+        if EJECT not in allowed:
+            allowed.insert(0, EJECT)
+        vm = dev.get("vm") or EJECT
+        if vm not in allowed:
+            allowed.append(vm)
+        return cls(
+            node, name, allowed, vm,
+            vendor_id=dev.get("vendor_id"),
+            product_id=dev.get("product_id"),
+            serial=dev.get("serial"),
+            port_path=dev.get("port_path"),
+        )
+
+    @property
+    def vid_pid(self):
+        if self.vendor_id is None or self.product_id is None:
+            return None
+        return f"{self.vendor_id}:{self.product_id}"
+
+    @property
+    def identity(self):
+        return self.vid_pid, self.serial or self.port_path or self.device_node
+
+    def with_vm(self, vm):
+        vm = vm or EJECT
+        allowed = self.allowed_vms if vm in self.allowed_vms else self.allowed_vms + (vm,)
+        return USBDevice(
+            self.device_node, self.product_name, allowed, vm,
+            self.vendor_id, self.product_id, self.serial, self.port_path,
+        )
+
+    def to_dict(self):
+        return {f: list(self.allowed_vms) if f == "allowed_vms" else getattr(self, f)
+                for f in self.__slots__}
+
+
+def parse_usb_list(response):
+    devices = []
+    if response.get("result") == "ok":
+        for dev in response.get("usb_devices", []):
+            device = USBDevice.from_wire(dev)
+            if device is not None:
+                devices.append(device)
+    return devices
+
+
+class DeviceRegistry:
+    """Devices indexed by device_node and by a stable display name.
+
+    A device keeps its display name for as long as it stays registered;
+    duplicates of a product name get the lowest free "name(N)" suffix, with
+    devices from a full list assigned in device_node order.
+    """
+
+    def __init__(self, devices=()):
+        self._by_node = {}
+        self._names = {}
+        self._by_name = {}
+        self.replace(devices)
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(parse_usb_list(response))
+
+    def __len__(self):
+        return len(self._by_node)
+
+    def __contains__(self, device_node):
+        return device_node in self._by_node
+
+    def get(self, device_node):
+        return self._by_node.get(device_node)
+
+    def by_display_name(self, name):
+        node = self._by_name.get(name)
+        return None if node is None else self._by_node[node]
+
+    def display_name(self, device_node):
+        return self._names.get(device_node)
+
+    def replace(self, devices):
+        devices = sorted(devices, key=lambda d: d.device_node)
+        keep = {d.device_node for d in devices}
+        for node in list(self._by_node):
+            if node not in keep:
+                self.remove(node)
+        for device in devices:
+            self.upsert(device)
+
+    def upsert(self, device):
+        node = device.device_node
+        old = self._by_node.get(node)
+        if old is not None and old.product_name != device.product_name:
+            self._release_name(node)
+        self._by_node[node] = device
+        if node not in self._names:
+            name = self._free_name(device.product_name)
+            self._names[node] = name
+            self._by_name[name] = node
+        return device
+
+    def remove(self, device_node):
+        device = self._by_node.pop(device_node, None)
+        if device is not None:
+            self._release_name(device_node)
+        return device
+
+    def _release_name(self, device_node):
+        name = self._names.pop(device_node, None)
+        if name is not None:
+            self._by_name.pop(name, None)
+
+    def _free_name(self, base):
+        if base not in self._by_name:
+            return base
+        idx = 1
+        while f"{base}({idx})" in self._by_name:
+            idx += 1
+        return f"{base}({idx})"
+
+    def __iter__(self):
+        return iter(self._by_node.values())
+
+    def items(self):
+        return ((self._names[node], dev) for node, dev in self._by_node.items())
+
+    def device_map(self):
+        return dict(self.items())
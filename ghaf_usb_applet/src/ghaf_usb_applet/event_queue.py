@@ -0,0 +1,182 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Bounded queue between the notification reader and the event handler, so
+# a slow handler no longer stalls reading from the host. Events are
+# handled in arrival order, which keeps them ordered per device_node. A
+# pending event that a newer one for the same device makes pointless
+# (attach then detach, anything then disconnect) is replaced in place.
+# When events are dropped on overflow an OVERFLOW_EVENT is queued; it is
+# not a hotplug event, so DeviceStore.apply_event() rejects it and the
+# consumer re-reads the device list.
+
+import collections
+import threading
+
+from ghaf_usb_applet import metrics
+from ghaf_usb_applet.logger import logger
+
+DEFAULT_QUEUE_SIZE = 256
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+BLOCK = "block"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+OVERFLOW_EVENT = "events_dropped"
+
+# New event -> kinds of pending event for the same device it replaces.
+SUPERSEDES = {
+    "usb_attached": frozenset({"usb_attached", "usb_detached"}),
+    "usb_detached": frozenset({"usb_attached", "usb_detached"}),
+    "usb_disconnected": frozenset({"usb_attached", "usb_detached", "usb_select_vm"}),
+}
+
+
+def _device_node(msg):
+    return (msg.get("usb_device") or {}).get("device_node") or msg.get("device_node")
+
+
+class EventQueue:
+    """Thread-safe bounded FIFO of notification messages.
+
+    ``put()`` applies the overflow ``policy`` when ``maxsize`` events are
+    pending: DROP_OLDEST discards the oldest, DROP_NEWEST the new one, and
+    BLOCK waits for room (or returns False at once with ``block=False``).
+    """
+
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST, name="notifications"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.name = name
+        self.dropped = 0
+        self.superseded = 0
+        self._entries = collections.deque()
+        self._last = {}
+        self._marker = False
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._entries)
+
+    def put(self, msg, block=True):
+        """Queue ``msg``; False if it was dropped or there was no room."""
+        node = _device_node(msg)
+        with self._cond:
+            if self._closed:
+                return False
+            if self._supersede(node, msg):
+                return True
+            # The overflow marker does not count against maxsize.
+            while len(self._entries) - self._marker >= self.maxsize:
+                if self.policy == DROP_OLDEST:
+                    # Evicting the marker frees no room and drops no event;
+                    # the next pass drops one and queues a new marker.
+                    if self._pop_locked().get("event") != OVERFLOW_EVENT:
+                        self._drop_locked()
+                elif self.policy == DROP_NEWEST:
+                    self._drop_locked()
+                    self._publish_locked()
+                    return False
+                elif not block:
+                    return False
+                else:
+                    self._cond.wait()
+                    if self._closed:
+                        return False
+            entry = [node, msg]
+            self._entries.append(entry)
+            if node is not None:
+                self._last[node] = entry
+            self._publish_locked()
+            self._cond.notify()
+            return True
+
+    def _supersede(self, node, msg):
+        kinds = SUPERSEDES.get(msg.get("event"))
+        if node is None or kinds is None:
+            return False
+        # Only the device's latest pending event can be replaced, so events
+        # for one device are never reordered.
+        entry = self._last.get(node)
+        if entry is None or entry[1].get("event") not in kinds:
+            return False
+        entry[1] = msg
+        self.superseded += 1
+        metrics.inc("ghaf_usb_event_queue_dropped_total", client=self.name, reason="superseded")
+        return True
+
+    def _drop_locked(self):
+        self.dropped += 1
+        metrics.inc("ghaf_usb_event_queue_dropped_total", client=self.name, reason="overflow")
+        if not self._marker:
+            self._marker = True
+            self._entries.append([None, {"event": OVERFLOW_EVENT}])
+            logger.warning("Event queue %s overflowed, dropping events", self.name)
+
+    def _pop_locked(self):
+        node, msg = entry = self._entries.popleft()
+        if node is not None and self._last.get(node) is entry:
+            del self._last[node]
+        if msg.get("event") == OVERFLOW_EVENT:
+            self._marker = False
+        return msg
+
+    def _publish_locked(self):
+        metrics.set_gauge("ghaf_usb_event_queue_depth", len(self._entries), client=self.name)
+
+    def get(self, timeout=None):
+        """Next message, waiting up to ``timeout``; None if closed or timed out."""
+        with self._cond:
+            while not self._entries and not self._closed:
+                if not self._cond.wait(timeout):
+                    break
+            if not self._entries:
+                return None
+            msg = self._pop_locked()
+            self._publish_locked()
+            self._cond.notify()
+            return msg
+
+    def get_nowait(self):
+        return self.get(0)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._entries.clear()
+            self._last.clear()
+            self._publish_locked()
+            self._cond.notify_all()
+
+
+class ThreadedDispatcher:
+    """Calls ``handler(msg)`` for queued messages on a worker thread.
+
+    Use an instance as APIClient.on_event: the reader only queues.
+    """
+
+    def __init__(self, handler, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST,
+                 name="notifications"):
+        self.handler = handler
+        self.queue = EventQueue(maxsize, policy, name)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, msg):
+        self.queue.put(msg)
+
+    def _run(self):
+        while True:
+            msg = self.queue.get()
+            if msg is None:
+                return
+            try:
+                self.handler(msg)
+            except Exception:
+                logger.exception("API event handler failed")
+
+    def close(self):
+        self.queue.close()
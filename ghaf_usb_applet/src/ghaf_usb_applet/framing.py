@@ -0,0 +1,75 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+from ghaf_usb_applet.logger import logger
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_CHUNK_SIZE = 65536
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+class FrameDecoder:
+    """Incremental decoder for newline-delimited frames.
+
+    Bytes are received into a reusable scratch buffer and accumulated in a
+    bytearray; only complete frames are decoded to str, so a multi-byte
+    UTF-8 sequence split across reads stays intact. The newline search
+    resumes where the previous one stopped, keeping large frames linear.
+    All frames completed by a read are decoded in one call; a frame that
+    is not valid UTF-8 is logged and dropped.
+    """
+
+    def __init__(self, max_frame=MAX_FRAME_SIZE, chunk_size=RECV_CHUNK_SIZE):
+        self.max_frame = max_frame
+        self._buf = bytearray()
+        self._scan = 0
+        self._chunk = memoryview(bytearray(chunk_size))
+
+    def reset(self):
+        self._buf.clear()
+        self._scan = 0
+
+    def recv_into(self, sock):
+        n = sock.recv_into(self._chunk)
+        self._buf += self._chunk[:n]
+        return n
+
+    def feed(self, data):
+        self._buf += data
+        return self.frames()
+
+    def frames(self):
+        """The complete frames received so far, as a list of str."""
+        buf = self._buf
+        last = buf.rfind(b"\n", self._scan)
+        if last < 0:
+            self._scan = len(buf)
+            if self._scan > self.max_frame:
+                self.reset()
+                raise FrameTooLarge(f"Partial frame exceeds {self.max_frame} bytes")
+            return []
+        block = buf[:last]
+        del buf[:last + 1]
+        self._scan = 0
+        # Frames are measured in bytes; only a block longer than the limit
+        # can hold one that exceeds it.
+        if last > self.max_frame and max(map(len, block.split(b"\n"))) > self.max_frame:
+            self.reset()
+            raise FrameTooLarge(f"Frame exceeds {self.max_frame} bytes")
+        try:
+            return block.decode("utf-8").split("\n")
+        except UnicodeDecodeError:
+            return _decode_each(block.split(b"\n"))
+
+
+def _decode_each(raw_frames):
+    frames = []
+    for raw in raw_frames:
+        try:
+            frames.append(raw.decode("utf-8"))
+        except UnicodeDecodeError as e:
+            logger.warning("Dropping frame that is not valid UTF-8: %s", e)
+    return frames
@@ -1,45 +1,238 @@
 # Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
 # SPDX-License-Identifier: Apache-2.0
 
+import collections
+import json
 import logging
-from functools import wraps
+import os
+import signal
+import threading
+import time
 
 MODULE_NAME = "ghaf_usb_applet"
+LOG_FORMAT_ENV = "GHAF_USB_LOG_FORMAT"
+RING_ENV = "GHAF_USB_LOG_RING"
+RING_SIZE = 1000
+RATE_LIMIT_BURST = 10
+RATE_LIMIT_INTERVAL = 60.0
+RATE_LIMIT_KEYS = 1024
 
 logger = logging.getLogger(MODULE_NAME)
-CALL_TRACER = True
 
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "critical": logging.CRITICAL,
+}
 
-def setup_logger(level: str = "info"):
+# Attributes every LogRecord has; anything else was passed via extra= and
+# is emitted as a structured field.
+_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime", "suppressed"}
+
+ring = None
+
+
+class Lazy:
+    """Defers ``func(*args)`` until a handler actually formats the record."""
+
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def _dumps_pretty(obj):
+    return json.dumps(obj, indent=4, sort_keys=True, default=str)
+
+
+def pretty_json(obj):
+    return Lazy(_dumps_pretty, obj)
+
+
+def _fields(record):
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS}
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(f"[{MODULE_NAME}] %(levelname)s %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = _fields(record)
+        if fields:
+            text += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            text += f" ({suppressed} similar messages suppressed)"
+        return text
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, for journald and log shippers."""
+
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(_fields(record))
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Pass at most ``burst`` repeats of a message every ``interval`` seconds.
+
+    Records repeat when they have the same format string and arguments,
+    compared unformatted. The first record let through after a suppressed
+    run carries the number of records dropped in its ``suppressed``
+    attribute. At most ``max_keys`` messages are tracked.
+    """
+
+    def __init__(self, burst=RATE_LIMIT_BURST, interval=RATE_LIMIT_INTERVAL,
+                 max_keys=RATE_LIMIT_KEYS):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_keys = max_keys
+        self._seen = {}
+        # Handlers are shared by the reader, dispatcher and broker threads.
+        self._lock = threading.Lock()
+
+    def _key(self, record):
+        key = (record.msg, record.args)
+        try:
+            hash(key)
+        except TypeError:
+            key = (record.msg, repr(record.args))
+        return key
+
+    def filter(self, record):
+        key = self._key(record)
+        now = record.created
+        with self._lock:
+            start, count, dropped = self._seen.get(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            if count >= self.burst:
+                self._seen[key] = (start, count, dropped + 1)
+                return False
+            record.suppressed = dropped
+            if key not in self._seen and len(self._seen) >= self.max_keys:
+                self._prune_locked(now)
+            self._seen[key] = (start, count + 1, 0)
+            return True
+
+    def _prune_locked(self, now):
+        self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.interval}
+        while len(self._seen) >= self.max_keys:
+            del self._seen[next(iter(self._seen))]
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last ``capacity`` records, unformatted, for dump()."""
+
+    def __init__(self, capacity=RING_SIZE):
+        super().__init__(logging.DEBUG)
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def dump(self, stream, formatter=None):
+        formatter = formatter or TextFormatter()
+        records = list(self.records)
+        for record in records:
+            try:
+                stream.write(formatter.format(record) + "\n")
+            except Exception:  # pylint: disable=broad-except
+                stream.write(f"<unformattable record {record.msg!r}>\n")
+        return len(records)
+
+
+def dump_ring(path=None):
+    """Write the ring buffer to ``path`` (default: a file in $XDG_RUNTIME_DIR)."""
+    if ring is None:
+        return None
+    if path is None:
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+        path = os.path.join(runtime_dir, f"{MODULE_NAME}-{os.getpid()}-{int(time.time())}.log")
+    with open(path, "w", encoding="utf-8") as f:
+        count = ring.dump(f)
+    logger.warning("Dumped %d recent log records to %s", count, path)
+    return path
+
+
+def _on_dump_signal(_signum, _frame):
+    # Formatting may take a while; keep it out of the signal handler.
+    threading.Thread(target=dump_ring, daemon=True).start()
+
+
+# pylint: disable=too-many-arguments
+def setup_logger(level: str = "info", fmt=None, rate_limit=True, ring_size=None,
+                 dump_signal=signal.SIGUSR1):
+    """Configure the package logger.
+
+    ``fmt`` is "text" or "json"; by default JSON lines are used when stderr
+    is connected to journald ($JOURNAL_STREAM) or $GHAF_USB_LOG_FORMAT says
+    so. With ``ring_size`` (default: $GHAF_USB_LOG_RING, else off) the last
+    records of every level, including debug, are kept unformatted in memory
+    and written out by ``dump_ring()`` or on ``dump_signal``. That needs the
+    logger at debug level, so every debug call then builds a record; without
+    the ring the logger stays at ``level``.
+    """
+    global ring
+    if ring_size is None:
+        ring_size = _ring_size_from_env()
+    fmt = fmt or os.environ.get(LOG_FORMAT_ENV) or (
+        "json" if os.environ.get("JOURNAL_STREAM") else "text"
+    )
     handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(f"[{MODULE_NAME}] %(levelname)s %(message)s"))
+    handler.setFormatter(JSONFormatter() if fmt == "json" else TextFormatter())
+    handler.setLevel(LEVELS.get(level, logging.INFO))
+    if rate_limit:
+        handler.addFilter(RateLimitFilter())
     logger.addHandler(handler)
 
-    if level == "info":
-        logger.setLevel(logging.INFO)
-    elif level == "debug":
+    if ring_size:
+        ring = RingBufferHandler(ring_size)
+        logger.addHandler(ring)
         logger.setLevel(logging.DEBUG)
-    elif level == "error":
-        logger.setLevel(logging.ERROR)
-    elif level == "warning":
-        logger.setLevel(logging.WARNING)
-    elif level == "critical":
-        logger.setLevel(logging.CRITICAL)
+        if dump_signal is not None and threading.current_thread() is threading.main_thread():
+            signal.signal(dump_signal, _on_dump_signal)
     else:
-        logger.setLevel(logging.INFO)
+        logger.setLevel(handler.level)
 
 
-def log_entry_exit(func):
-    if not CALL_TRACER:
-        return func
+def _ring_size_from_env():
+    value = os.environ.get(RING_ENV)
+    if not value:
+        return 0
+    try:
+        return max(0, int(value))
+    except ValueError:
+        logger.warning("Ignoring invalid %s=%r", RING_ENV, value)
+        return 0
 
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        logger.debug("Entering %s", func.__qualname__)
-        try:
-            return func(*args, **kwargs)
-        finally:
-            logger.debug("Exiting %s", func.__qualname__)
 
-    return wrapper
+def log_entry_exit(func):
+    """Mark ``func`` as a hot path for the profiler (see profiling.py).
 
+    While profiling is off the function is returned unchanged; with
+    ``enable(trace=True)`` entry and exit are also logged at debug level.
+    """
+    from ghaf_usb_applet import profiling  # pylint: disable=import-outside-toplevel
+    return profiling.register(func)
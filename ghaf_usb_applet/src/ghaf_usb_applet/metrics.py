@@ -0,0 +1,260 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Process-local counters, gauges and latency histograms, exported in the
+# Prometheus text format either to a file (for the node_exporter textfile
+# collector) or to whoever connects to a Unix socket. Collection is off
+# unless enable() is called; instrumented code checks ``metrics.ENABLED``
+# before doing any work, so the disabled cost is one global lookup.
+
+import os
+import socket
+import threading
+import time
+
+from ghaf_usb_applet.logger import logger
+
+METRICS_ENV = "GHAF_USB_METRICS"
+DEFAULT_INTERVAL = 15
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0,
+)
+
+ENABLED = False
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_help = {}
+_exporter = None
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def describe(name, text):
+    _help[name] = text
+
+
+def inc(name, value=1, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _gauges[key] = value
+
+
+def observe(name, seconds, **labels):
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = _Histogram(LATENCY_BUCKETS)
+        hist.observe(seconds)
+
+
+def track_future(name, future, outcome, **labels):
+    """Observe the time until ``future`` completes, labelled by ``outcome(future)``."""
+    if not ENABLED:
+        return
+    start = time.perf_counter()
+
+    def _done(f):
+        result = outcome(f)
+        observe(name + "_seconds", time.perf_counter() - start, **labels)
+        inc(name + "_total", result=result, **labels)
+
+    future.add_done_callback(_done)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _labels(pairs, extra=()):
+    pairs = tuple(pairs) + tuple(extra)
+    if not pairs:
+        return ""
+    text = ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + text + "}"
+
+
+def render():
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted(
+            ((key, list(h.counts), h.sum, h.count, h.buckets) for key, h in _histograms.items()),
+            key=lambda item: item[0],
+        )
+    lines = []
+    seen = set()
+
+    def _header(name, kind):
+        if name in seen:
+            return
+        seen.add(name)
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        _header(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), value in gauges:
+        _header(name, "gauge")
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), counts, total, count, buckets in histograms:
+        _header(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(buckets, counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+class Exporter:
+    """Exports render() to ``textfile:/path`` every ``interval`` seconds or
+    serves it on ``unix:/path``, one snapshot per connection."""
+
+    def __init__(self, spec, interval=DEFAULT_INTERVAL):
+        self.kind, _, self.path = spec.partition(":")
+        if self.kind not in ("textfile", "unix") or not self.path:
+            raise ValueError(f"Unknown metrics export: {spec}")
+        self.interval = interval
+        self._stop = threading.Event()
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        if self.kind == "unix":
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(self.path)
+            self._sock.listen(4)
+            target = self._serve
+        else:
+            target = self._write_loop
+        self._thread = threading.Thread(target=target, daemon=True)
+        self._thread.start()
+        logger.info("Exporting metrics to %s:%s", self.kind, self.path)
+        return self
+
+    def _write_loop(self):
+        while True:
+            try:
+                write_textfile(self.path)
+            except OSError as e:
+                logger.warning("Failed writing metrics to %s: %s", self.path, e)
+            if self._stop.wait(self.interval):
+                return
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    conn.sendall(render().encode("utf-8"))
+                except OSError:
+                    pass
+
+    def stop(self):
+        self._stop.set()
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        elif self._thread is not None:
+            self._thread.join(1)
+            try:
+                write_textfile(self.path)
+            except OSError:
+                pass
+
+
+def enable(spec=None, interval=DEFAULT_INTERVAL):
+    """Start collecting; export to ``spec`` (or $GHAF_USB_METRICS) if given."""
+    global ENABLED, _exporter
+    spec = spec or os.environ.get(METRICS_ENV)
+    ENABLED = True
+    if spec and _exporter is None:
+        _exporter = Exporter(spec, interval).start()
+
+
+def disable():
+    global ENABLED, _exporter
+    ENABLED = False
+    if _exporter is not None:
+        _exporter.stop()
+        _exporter = None
+
+
+def setup_metrics(spec=None):
+    """Enable collection when ``spec`` or $GHAF_USB_METRICS names an export."""
+    if spec or os.environ.get(METRICS_ENV):
+        enable(spec)
+
+
+describe("ghaf_usb_api_request_seconds", "Latency of vHotplug API requests by action")
+describe("ghaf_usb_api_request_total", "vHotplug API requests by action and result")
+describe("ghaf_usb_api_reconnects_total", "API connections re-established after a loss")
+describe("ghaf_usb_api_dial_failures_total", "Failed API connection attempts")
+describe("ghaf_usb_refresh_pending", "Device list refreshes queued or in flight")
+describe("ghaf_usb_refresh_total", "Device list refresh requests by outcome")
+describe("ghaf_usb_event_to_ui_seconds", "Time from a hotplug notification to the rebuilt menu")
+describe("ghaf_usb_autoroute_total", "Devices attached by a routing rule, by result")
+describe("ghaf_usb_event_queue_depth", "Notifications waiting to be handled")
+describe("ghaf_usb_event_queue_dropped_total",
+         "Notifications dropped on overflow or replaced by a newer one for the device")
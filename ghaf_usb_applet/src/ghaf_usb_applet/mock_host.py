@@ -0,0 +1,262 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Stand-in for the vHotplug API server, speaking the same newline-delimited
+# JSON protocol over AF_UNIX or loopback TCP. Point clients at it with
+# GHAF_USB_API_TRANSPORT=unix:/path or tcp:127.0.0.1:port. Requests on one
+# connection are answered in order; a concurrent host serves each request
+# on its own thread, so replies to pipelined requests may overlap their
+# latency and arrive out of order (matched by id).
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from ghaf_usb_applet.logger import logger, setup_logger
+
+DEFAULT_VMS = ["chrome-vm", "comms-vm", "business-vm"]
+
+
+def synthetic_devices(count, vms=None):
+    vms = vms or DEFAULT_VMS
+    devices = []
+    for i in range(count):
+        bus, dev = divmod(i, 127)
+        devices.append({
+            "device_node": f"/dev/bus/usb/{bus + 1:03d}/{dev + 1:03d}",
+            "vendor_id": f"{0x1000 + i % 64:04x}",
+            "product_id": f"{i:04x}",
+            "product_name": f"Synthetic_Device_{i}",
+            "allowed_vms": list(vms),
+            "vm": vms[i % len(vms)] if i % 4 else None,
+        })
+    return devices
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.server.host.track(self)
+
+    def write(self, msg):
+        data = (json.dumps(msg) + "\n").encode("utf-8")
+        with self.write_lock:
+            self.wfile.write(data)
+
+    def serve(self, msg):
+        host = self.server.host
+        if host.latency:
+            time.sleep(host.latency)
+        reply, event = host.handle(msg, self)
+        if "id" in msg:
+            reply["id"] = msg["id"]
+        try:
+            self.write(reply)
+        except OSError:
+            return
+        if event is not None:
+            host.push(event)
+
+    def handle(self):
+        host = self.server.host
+        try:
+            for line in self.rfile:
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    self.write({"result": "failed", "error": "invalid json"})
+                    continue
+                if host.concurrent:
+                    threading.Thread(target=self.serve, args=(msg,), daemon=True).start()
+                else:
+                    self.serve(msg)
+        except OSError:
+            pass
+        finally:
+            host.unsubscribe(self)
+            host.untrack(self)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MockHost:
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, devices=None, transport="unix:/tmp/ghaf-usb-mock.sock", latency=0.0,
+                 concurrent=False):
+        self.devices = {d["device_node"]: dict(d) for d in devices or []}
+        self.transport = transport
+        self.latency = latency
+        self.concurrent = concurrent
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._connections = set()
+        self._server = None
+        self._thread = None
+
+    def handle(self, msg, conn):
+        action = msg.get("action")
+        with self._lock:
+            self.requests += 1
+            if action == "usb_list":
+                return {"result": "ok", "usb_devices": [dict(d) for d in self.devices.values()]}, None
+            if action == "enable_notifications":
+                self._subscribers.append(conn)
+                return {"result": "ok"}, None
+            dev = self.devices.get(msg.get("device_node"))
+            if action not in ("usb_attach", "usb_detach"):
+                return {"result": "failed", "error": f"unknown action {action}"}, None
+            if dev is None:
+                return {"result": "failed", "error": "device not found"}, None
+            if action == "usb_detach":
+                dev["vm"] = None
+                return {"result": "ok"}, {"event": "usb_detached", "usb_device": dict(dev)}
+            vm = msg.get("vm")
+            if vm not in dev.get("allowed_vms", []):
+                return {"result": "failed", "error": f"{vm} not allowed"}, None
+            dev["vm"] = vm
+            return {"result": "ok"}, {"event": "usb_attached", "usb_device": dict(dev), "vm": vm}
+
+    def push(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for conn in subscribers:
+            try:
+                conn.write(event)
+            except OSError:
+                self.unsubscribe(conn)
+
+    def unsubscribe(self, conn):
+        with self._lock:
+            if conn in self._subscribers:
+                self._subscribers.remove(conn)
+
+    def track(self, conn):
+        with self._lock:
+            self._connections.add(conn)
+
+    def untrack(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+
+    def drop_connections(self):
+        with self._lock:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def connect_device(self, dev, select_vm=False):
+        with self._lock:
+            self.devices[dev["device_node"]] = dict(dev)
+        self.push({"event": "usb_connected", "usb_device": dict(dev)})
+        if select_vm:
+            self.push({
+                "event": "usb_select_vm",
+                "usb_device": dict(dev),
+                "allowed_vms": list(dev.get("allowed_vms", [])),
+            })
+
+    def disconnect_device(self, device_node):
+        with self._lock:
+            dev = self.devices.pop(device_node, None)
+        if dev is not None:
+            self.push({"event": "usb_disconnected", "usb_device": dev})
+
+    def run_script(self, lines):
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            step = json.loads(line)
+            if "sleep" in step:
+                time.sleep(step["sleep"])
+            elif step.get("event") == "usb_connected":
+                self.connect_device(step["usb_device"], step.get("select_vm", False))
+            elif step.get("event") == "usb_disconnected":
+                self.disconnect_device(step["usb_device"]["device_node"])
+            else:
+                self.push(step)
+
+    def start(self):
+        kind, _, address = self.transport.partition(":")
+        if kind == "unix":
+            if os.path.exists(address):
+                os.unlink(address)
+            self._server = _UnixServer(address, _Handler)
+        elif kind == "tcp":
+            host, _, port = address.rpartition(":")
+            self._server = _TCPServer((host or "127.0.0.1", int(port or 0)), _Handler)
+            self.transport = "tcp:%s:%s" % self._server.server_address[:2]
+        else:
+            raise ValueError(f"Unsupported mock transport: {self.transport}")
+        self._server.host = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info("Mock vHotplug host listening on %s", self.transport)
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self.drop_connections()
+            if isinstance(self._server, _UnixServer):
+                os.unlink(self._server.server_address)
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock vHotplug API server")
+    parser.add_argument("--transport", type=str, default="unix:/tmp/ghaf-usb-mock.sock",
+                        help="unix:/path or tcp:host:port")
+    parser.add_argument("--devices", type=int, default=5, help="Number of synthetic devices")
+    parser.add_argument("--vms", nargs="+", default=DEFAULT_VMS, help="Allowed VMs")
+    parser.add_argument("--latency", type=float, default=0.0, help="Per-request delay (sec)")
+    parser.add_argument("--concurrent", action="store_true",
+                        help="Serve requests on one connection concurrently")
+    parser.add_argument("--script", type=str, help="JSON-lines event script to replay")
+    parser.add_argument("--loglevel", type=str, default="info", help="Log level")
+    args = parser.parse_args()
+    setup_logger(args.loglevel)
+
+    host = MockHost(synthetic_devices(args.devices, args.vms), args.transport, args.latency,
+                    args.concurrent)
+    with host:
+        if args.script:
+            with open(args.script, encoding="utf-8") as f:
+                host.run_script(f)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
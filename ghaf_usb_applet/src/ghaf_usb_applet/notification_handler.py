@@ -1,11 +1,12 @@
 # Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
 # SPDX-License-Identifier: Apache-2.0
 
-import subprocess
-import json 
-
-from ghaf_usb_applet.api_client import APIClient
-from ghaf_usb_applet.logger import logger
+from ghaf_usb_applet import metrics
+from ghaf_usb_applet.api_client import is_success
+from ghaf_usb_applet.async_client import AsyncAPIClient
+from ghaf_usb_applet.chooser import ChooserClient
+from ghaf_usb_applet.logger import log_entry_exit, logger, pretty_json
+from ghaf_usb_applet.routing import Router
 
 def format_product_name(dev):
     product_name = dev.get('product_name', None)
@@ -16,50 +17,73 @@ def format_product_name(dev):
         dev['product_name'] = product_name[:20]
 
 class USBDeviceNotification:
-    def __init__(self, server_port=2000):
+    def __init__(self, server_port=2000, chooser=None, apiclient=None, router=None):
         self.port = server_port
         self.callback = None
+        self.chooser = chooser or ChooserClient(port=server_port)
+        self.router = router or Router()
+        self._attach_client = apiclient
 
-    def monitor(self, callback):
-        th, apiclient = APIClient.recv_notifications(
-            callback=self.notify_user, port=self.port, cid=2, reconnect_delay=3
-        )
-        self.apiclient = apiclient
+    @property
+    def attach_client(self):
+        if self._attach_client is None:
+            self._attach_client = AsyncAPIClient(port=self.port)
+            self._attach_client.start()
+        return self._attach_client
+
+    def monitor(self, callback, on_connected=None):
         self.callback = callback
-        return th
+        self.apiclient = AsyncAPIClient.recv_notifications(
+            callback=self.notify_user, port=self.port, cid=2, reconnect_delay=3,
+            on_connected=on_connected,
+        )
+        return self.apiclient
 
+    @log_entry_exit
     def notify_user(self, msg):
-        logger.info(f"Device notification: {json.dumps(msg, indent=4)}")
         event = msg.get('event', '')
+        logger.info("Device notification: %s", event,
+                    extra={"device_node": (msg.get("usb_device") or {}).get("device_node")})
+        logger.debug("Notification payload: %s", pretty_json(msg))
         if event == 'usb_select_vm':
             self.show_notif_window(msg)
         else:
-            self.callback()
+            self.callback(msg)
 
 
     def show_notif_window(self, msg):
         dev = msg.get("usb_device", {})
         allowed = msg.get("allowed_vms", [])
         if len(allowed) < 2:
-            logger.error(f"VMs not available to make choice")
+            logger.error("VMs not available to make choice")
             return
-        dev["allowed_vms"] = allowed
-        format_product_name(dev)
+        vm = self.router.route(dev, allowed)
+        if vm is not None:
+            self.auto_attach(dev, allowed, vm)
+            return
+        self._show_chooser(dev, allowed)
 
-        name = dev.get('product_name', '<unknown device>')
-        name = name.replace('_', ' ')
-        cmd = [
-            "usb_device",
-            "--title", "New device attached!",
-            "--device_node", dev.get('device_node', ''),
-            "--product_name", name,
-            "--allowed_vms", *dev.get('allowed_vms', ''),
-        ]
+    @log_entry_exit
+    def auto_attach(self, dev, allowed, vm):
+        node = dev.get("device_node")
+        logger.info("Auto-routing %s to %s", dev.get("product_name"), vm,
+                    extra={"device_node": node})
+
+        def _done(res, error):
+            if error is None and is_success(res):
+                metrics.inc("ghaf_usb_autoroute_total", result="ok")
+                return
+            metrics.inc("ghaf_usb_autoroute_total", result="failed")
+            logger.error("Auto-routing %s to %s failed: %s", node, vm,
+                         error if error is not None else res.get("error", res))
+            self._show_chooser(dev, allowed)
 
-        selected = dev.get('vm', None)
-        if selected:
-            cmd = cmd + ["--vm", selected]
+        self.attach_client.usb_attach(node, vm, _done)
 
-        logger.debug(cmd)
-        subprocess.Popen(cmd)
-        
+    def _show_chooser(self, dev, allowed):
+        dev = dict(dev, allowed_vms=allowed)
+        format_product_name(dev)
+
+        name = dev.get('product_name', '<unknown device>')
+        dev['product_name'] = name.replace('_', ' ')
+        self.chooser.show(dev, "New device attached!")
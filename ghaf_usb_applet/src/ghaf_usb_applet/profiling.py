@@ -0,0 +1,159 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Call counts and wall time for functions decorated with
+# logger.log_entry_exit. Until profiling is set up the decorated functions
+# are left untouched and cost nothing. setup_profiling() (or the first
+# enable()) installs wrappers into their classes and modules once; they
+# stay for the life of the process and only check ENABLED, so enable()
+# and disable() also reach bound methods captured after that point (io
+# watches, dispatcher handlers). Call it before building the objects; a
+# function imported by name or bound before then keeps the bare version.
+# An installed but disabled wrapper costs one extra call and a flag test.
+
+import atexit
+import signal
+import sys
+import threading
+import time
+from functools import wraps
+
+from ghaf_usb_applet.logger import logger
+
+ENABLED = False
+TRACE = False
+_installed = False
+
+_lock = threading.Lock()
+_registry = {}
+_stats = {}
+
+
+def _owner(func):
+    owner = sys.modules.get(func.__module__)
+    *path, name = func.__qualname__.split(".")
+    for part in path:
+        owner = getattr(owner, part, None)
+    return owner, name
+
+
+def _wrap(func):
+    key = f"{func.__module__}.{func.__qualname__}"
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        if TRACE:
+            logger.debug("Entering %s", func.__qualname__)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with _lock:
+                stat = _stats.get(key)
+                if stat is None:
+                    _stats[key] = [1, elapsed, elapsed]
+                else:
+                    stat[0] += 1
+                    stat[1] += elapsed
+                    if elapsed > stat[2]:
+                        stat[2] = elapsed
+            if TRACE:
+                logger.debug("Exiting %s", func.__qualname__)
+
+    wrapper.__profiled__ = func
+    return wrapper
+
+
+def register(func):
+    """Decorator: make ``func`` profileable. Returns it unchanged until
+    profiling has been set up."""
+    if "<locals>" not in func.__qualname__:
+        _registry[f"{func.__module__}.{func.__qualname__}"] = func
+    return _wrap(func) if _installed else func
+
+
+def _install():
+    global _installed
+    if _installed:
+        return
+    _installed = True
+    for func in _registry.values():
+        owner, name = _owner(func)
+        current = getattr(owner, name, None) if owner is not None else None
+        if current is None:
+            continue
+        # Class attributes are read from __dict__ to see the plain function
+        # rather than a bound method or an inherited attribute.
+        if isinstance(owner, type):
+            current = owner.__dict__.get(name)
+        if current is func:
+            setattr(owner, name, _wrap(func))
+
+
+def enable(trace=False):
+    global ENABLED, TRACE
+    TRACE = trace
+    if not ENABLED:
+        _install()
+        ENABLED = True
+        logger.info("Profiling enabled for %d functions", len(_registry))
+
+
+def disable():
+    global ENABLED
+    if ENABLED:
+        ENABLED = False
+        logger.info("Profiling disabled")
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def stats():
+    with _lock:
+        return {key: tuple(value) for key, value in _stats.items()}
+
+
+def report(limit=None):
+    rows = sorted(stats().items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    lines = [f"{'calls':>8} {'total ms':>10} {'mean ms':>9} {'max ms':>9}  function"]
+    for key, (calls, total, worst) in rows:
+        lines.append(
+            f"{calls:>8} {total * 1000:>10.2f} {total / calls * 1000:>9.3f} "
+            f"{worst * 1000:>9.3f}  {key}"
+        )
+    return "\n".join(lines)
+
+
+def log_report():
+    if _stats:
+        logger.info("Profile report:\n%s", report())
+
+
+def _on_toggle_signal(_signum, _frame):
+    if ENABLED:
+        log_report()
+        disable()
+        reset()
+    else:
+        enable(TRACE)
+
+
+def setup_profiling(enabled=False, trace=False, toggle_signal=signal.SIGUSR2):
+    """Enable profiling now and/or let ``toggle_signal`` switch it at runtime.
+
+    Installs the wrappers, so call it before the profiled objects are
+    built. Switching off with the signal logs the report collected so far;
+    a report is also logged at exit while profiling is on.
+    """
+    _install()
+    if toggle_signal is not None and threading.current_thread() is threading.main_thread():
+        signal.signal(toggle_signal, _on_toggle_signal)
+    atexit.register(lambda: ENABLED and log_report())
+    if enabled:
+        enable(trace)
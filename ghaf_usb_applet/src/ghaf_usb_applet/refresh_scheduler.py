@@ -0,0 +1,108 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+from gi.repository import GLib
+
+from ghaf_usb_applet import metrics
+from ghaf_usb_applet.logger import logger
+
+DEFAULT_DEBOUNCE_MS = 150
+
+
+class RefreshScheduler:
+    """Debounced, single-flight refresh on the GLib main loop.
+
+    ``fetch(callback)`` must start an asynchronous fetch and eventually call
+    ``callback(result, error)``; ``apply(result, error)`` consumes it. Requests
+    made within the debounce window, or while a fetch is in flight, are
+    coalesced into one trailing fetch. A result that was overtaken by newer
+    state (see ``mark_stale``) is dropped instead of applied.
+    """
+
+    def __init__(self, fetch, apply, debounce_ms=DEFAULT_DEBOUNCE_MS):
+        self._fetch = fetch
+        self._apply = apply
+        self.debounce_ms = debounce_ms
+        self._timer = None
+        self._in_flight = False
+        self._dirty = False
+        self._token = 0
+        self.requested = 0
+        self.coalesced = 0
+        self.fetched = 0
+        self.dropped = 0
+
+    def request(self):
+        self.requested += 1
+        if self._in_flight:
+            self._dirty = True
+            self.coalesced += 1
+            self._count("coalesced")
+        elif self._timer is not None:
+            self.coalesced += 1
+            self._count("coalesced")
+        else:
+            self._timer = GLib.timeout_add(self.debounce_ms, self._fire)
+        self._publish()
+
+    def _count(self, outcome):
+        metrics.inc("ghaf_usb_refresh_total", outcome=outcome)
+
+    def _publish(self):
+        if metrics.ENABLED:
+            metrics.set_gauge("ghaf_usb_refresh_pending", self.depth)
+
+    @property
+    def depth(self):
+        return (self._timer is not None) + self._in_flight + self._dirty
+
+    def mark_stale(self):
+        if self._in_flight:
+            self._dirty = True
+
+    def cancel(self):
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        self._token += 1
+        self._in_flight = False
+        self._dirty = False
+        self._publish()
+
+    def _fire(self):
+        self._timer = None
+        self._in_flight = True
+        self._dirty = False
+        self._token += 1
+        self.fetched += 1
+        self._count("fetched")
+        self._publish()
+        token = self._token
+        self._fetch(lambda result, error: self._done(token, result, error))
+        return GLib.SOURCE_REMOVE
+
+    def _done(self, token, result, error):
+        if token != self._token:
+            self.dropped += 1
+            self._count("dropped")
+            return
+        self._in_flight = False
+        if self._dirty:
+            self._dirty = False
+            self.dropped += 1
+            self._count("dropped")
+            logger.debug("Dropping stale refresh result, fetching again")
+            self._timer = GLib.timeout_add(self.debounce_ms, self._fire)
+            self._publish()
+            return
+        self._publish()
+        self._apply(result, error)
+
+    def stats(self):
+        return {
+            "requested": self.requested,
+            "coalesced": self.coalesced,
+            "fetched": self.fetched,
+            "dropped": self.dropped,
+            "pending": self._timer is not None or self._in_flight,
+        }
@@ -0,0 +1,252 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Auto-routing rules: devices matching a rule are attached to its VM as
+# soon as the host asks for a choice, without showing the chooser. Rules
+# live in $XDG_CONFIG_HOME/ghaf-usb-applet/rules.json and are compiled
+# into an index keyed by their exact fields, so a lookup costs a handful
+# of dict probes whatever the number of rules; only rules without any
+# exact field are tried one by one.
+
+import fnmatch
+import json
+import os
+import re
+
+from ghaf_usb_applet.devices import EJECT, UNKNOWN_DEVICE
+from ghaf_usb_applet.logger import logger
+
+RULES_VERSION = 1
+RULES_FILE = "rules.json"
+# Fields in the order they are tried as a rule's index key, most
+# selective first.
+FIELDS = ("serial", "vid_pid", "port_path", "product_name")
+FIELD_LABELS = {
+    "vid_pid": "Vendor:Product",
+    "serial": "Serial",
+    "port_path": "Port",
+    "product_name": "Name",
+}
+_GLOB_CHARS = frozenset("*?[")
+DEVICE_PRIORITY = 10
+
+
+def rules_path():
+    config_dir = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return os.path.join(config_dir, "ghaf-usb-applet", RULES_FILE)
+
+
+def _normalize(field, value):
+    if value is None:
+        return None
+    value = str(value)
+    if field == "product_name":
+        return value.replace("_", " ").lower()
+    if field == "vid_pid":
+        return value.lower()
+    return value
+
+
+def device_fields(dev):
+    """Matchable fields of a device dict as sent by the host."""
+    vendor, product = dev.get("vendor_id"), dev.get("product_id")
+    name = dev.get("product_name")
+    if name is not None and (name.isdigit() or name == UNKNOWN_DEVICE):
+        name = None
+    fields = {
+        "serial": dev.get("serial"),
+        "vid_pid": f"{vendor}:{product}" if vendor is not None and product is not None else None,
+        "port_path": dev.get("port_path"),
+        "product_name": name,
+    }
+    return {field: _normalize(field, value) for field, value in fields.items()}
+
+
+class Rule:
+    """Route devices whose fields match all given patterns to ``vm``.
+
+    Patterns are shell globs; fields left as None match anything. Among
+    matching rules the highest ``priority`` wins, then the earliest rule.
+    """
+
+    __slots__ = ("vm", "priority", "patterns", "_compiled")
+
+    def __init__(self, vm, priority=0, **patterns):
+        unknown = set(patterns) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown rule fields: {', '.join(sorted(unknown))}")
+        self.vm = vm
+        self.priority = int(priority)
+        self.patterns = {
+            field: _normalize(field, patterns[field]) for field in FIELDS
+            if patterns.get(field) not in (None, "")
+        }
+        if not vm or vm == EJECT:
+            raise ValueError("Rule needs a target VM")
+        if not self.patterns:
+            raise ValueError("Rule needs at least one pattern")
+        self._compiled = {
+            field: re.compile(fnmatch.translate(pattern)).match
+            for field, pattern in self.patterns.items()
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get("vm"), data.get("priority", 0),
+                   **{field: data.get(field) for field in FIELDS})
+
+    def to_dict(self):
+        return dict(self.patterns, vm=self.vm, priority=self.priority)
+
+    def index_key(self):
+        for field in FIELDS:
+            pattern = self.patterns.get(field)
+            if pattern is None:
+                continue
+            if not _GLOB_CHARS & set(pattern):
+                return field, pattern
+            vendor, sep, product = pattern.partition(":")
+            if field == "vid_pid" and sep and product == "*" and not _GLOB_CHARS & set(vendor):
+                return "vendor", vendor
+        return None
+
+    def matches(self, fields):
+        for field, match in self._compiled.items():
+            value = fields.get(field)
+            if value is None or match(value) is None:
+                return False
+        return True
+
+    def describe(self):
+        return ", ".join(f"{FIELD_LABELS[f]} {p}" for f, p in self.patterns.items())
+
+    def __repr__(self):
+        return f"Rule({self.vm!r}, {self.priority}, {self.patterns!r})"
+
+
+def _literal(value):
+    return re.sub(r"([*?[])", r"[\1]", value)
+
+
+def rule_for_device(device, vm, priority=DEVICE_PRIORITY):
+    """A rule matching one USBDevice, by vendor:product and serial when known."""
+    patterns = {}
+    if device.vid_pid is not None:
+        patterns["vid_pid"] = _literal(device.vid_pid)
+    if device.serial:
+        patterns["serial"] = _literal(device.serial)
+    if not patterns:
+        patterns["product_name"] = _literal(device.product_name)
+    return Rule(vm, priority, **patterns)
+
+
+def add_rule(rules, rule):
+    """``rules`` with ``rule`` added, replacing one with the same patterns."""
+    return [r for r in rules if r.patterns != rule.patterns] + [rule]
+
+
+class RuleSet:
+    """Rules compiled into an index for constant-time lookups."""
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        self._index = {}
+        self._scan = []
+        for order, rule in enumerate(self.rules):
+            entry = (-rule.priority, order, rule)
+            key = rule.index_key()
+            if key is None:
+                self._scan.append(entry)
+            else:
+                self._index.setdefault(key, []).append(entry)
+        for entries in self._index.values():
+            entries.sort(key=lambda e: e[:2])
+        self._scan.sort(key=lambda e: e[:2])
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _candidates(self, fields):
+        for field in FIELDS:
+            value = fields.get(field)
+            if value is not None:
+                yield from self._index.get((field, value), ())
+        vid_pid = fields.get("vid_pid")
+        if vid_pid is not None:
+            yield from self._index.get(("vendor", vid_pid.partition(":")[0]), ())
+        yield from self._scan
+
+    def lookup(self, dev, allowed_vms=None):
+        """The best rule for device dict ``dev`` whose VM is allowed, or None."""
+        if not self.rules:
+            return None
+        fields = device_fields(dev)
+        best = None
+        for entry in self._candidates(fields):
+            rule = entry[2]
+            if best is not None and entry[:2] >= best[:2]:
+                continue
+            if allowed_vms is not None and rule.vm not in allowed_vms:
+                continue
+            if rule.matches(fields):
+                best = entry
+        return None if best is None else best[2]
+
+
+def load_rules(path=None):
+    path = path or rules_path()
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable routing rules %s: %s", path, e)
+        return []
+    if not isinstance(data, dict) or data.get("version") != RULES_VERSION:
+        logger.warning("Ignoring routing rules %s with another format version", path)
+        return []
+    rules = []
+    for entry in data.get("rules") or []:
+        try:
+            rules.append(Rule.from_dict(entry))
+        except (AttributeError, TypeError, ValueError) as e:
+            logger.warning("Skipping invalid routing rule %s: %s", entry, e)
+    return rules
+
+
+def save_rules(rules, path=None):
+    path = path or rules_path()
+    data = {"version": RULES_VERSION, "rules": [rule.to_dict() for rule in rules]}
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+    logger.info("Saved %d routing rules to %s", len(rules), path)
+
+
+class Router:
+    """RuleSet backed by the rules file, recompiled whenever it changes."""
+
+    def __init__(self, path=None):
+        self.path = path or rules_path()
+        self.rules = RuleSet()
+        self._stamp = None
+
+    def _reload(self):
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            stamp = None
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self.rules = RuleSet(load_rules(self.path) if stamp else ())
+            logger.debug("Loaded %d routing rules from %s", len(self.rules), self.path)
+
+    def route(self, dev, allowed_vms):
+        """VM to attach ``dev`` to without asking, or None."""
+        self._reload()
+        rule = self.rules.lookup(dev, allowed_vms)
+        return None if rule is None else rule.vm
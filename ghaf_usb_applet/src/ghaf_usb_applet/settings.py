@@ -1,22 +1,65 @@
 # Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
 # SPDX-License-Identifier: Apache-2.0
 
+import json
+import time
+
 import gi
 gi.require_version("Gtk", "4.0")
 gi.require_version("Gdk", "4.0")
-from gi.repository import Gtk, Gdk, Pango, GLib
+from gi.repository import Gtk, Gdk, Gio, GLib, GObject, Pango
 
-from ghaf_usb_applet.api_client import APIClient
-from ghaf_usb_applet.logger import logger
+from ghaf_usb_applet.api_client import CONNECTED, RECONNECTING, is_success
+from ghaf_usb_applet.async_client import AsyncAPIClient
+from ghaf_usb_applet.device_store import DeviceStore
+from ghaf_usb_applet.devices import EJECT
+from ghaf_usb_applet.logger import Lazy, log_entry_exit, logger
+from ghaf_usb_applet.refresh_scheduler import RefreshScheduler
+from ghaf_usb_applet.routing import (
+    FIELD_LABELS, FIELDS, Rule, add_rule, load_rules, rule_for_device, save_rules,
+)
+
+
+def _model_dump(items):
+    return json.dumps({name: dev.to_dict() for name, dev in items}, indent=4, sort_keys=True)
+
+
+class DeviceItem(GObject.Object):
+    """List model entry for one device; rows bind to ``name`` and ``vm``."""
+
+    __gtype_name__ = "GhafUsbDeviceItem"
+
+    name = GObject.Property(type=str, default="")
+    vm = GObject.Property(type=str, default="")
+
+    def __init__(self, name, device):
+        super().__init__(name=name, vm=str(device.vm))
+        self.device = device
+
+    def update(self, name, device):
+        self.device = device
+        if self.name != name:
+            self.name = name
+        if self.vm != str(device.vm):
+            self.vm = str(device.vm)
 
-import json
 
 class OptionsPopover(Gtk.Popover):
+    """Pick one of ``options``; ``on_chosen(option, remember)`` is called
+    with whether "Always route this device here" was checked.
+
+    Clicking the option that is already selected does not toggle it, so
+    closing the popover with the box checked and no new choice remembers
+    the current option.
+    """
+
+    # pylint: disable=too-many-positional-arguments
     def __init__(self, parent_widget, title, options, selected, on_chosen):
         super().__init__(has_arrow=True)
         self.set_parent(parent_widget)
         self._selected = selected
         self._on_chosen = on_chosen
+        self._chosen = False
 
         box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=8)
         box.set_margin_top(10); box.set_margin_bottom(10)
@@ -40,26 +83,59 @@ class OptionsPopover(Gtk.Popover):
             btn.connect("toggled", self._on_toggled, opt)
             box.append(btn)
 
+        self.remember = Gtk.CheckButton.new_with_label("Always route this device here")
+        box.append(self.remember)
+
         self.set_autohide(True)
+        self.connect("closed", self._on_closed)
 
 
     def _on_toggled(self, btn, opt):
         if not btn.get_active():
             return
-        if opt != self._selected:
-            self._selected = opt
-            self._on_chosen(opt)
+        self._selected = opt
+        self._chosen = True
+        self._on_chosen(opt, self.remember.get_active())
         self.popdown()
 
+    def _on_closed(self, _pop):
+        if not self._chosen and self.remember.get_active() and self._selected is not None:
+            self._chosen = True
+            self._on_chosen(self._selected, True)
+
 
 class DeviceSettings(Gtk.ApplicationWindow):
-    def __init__(self, port, **kwargs):
+    """Device passthrough settings.
+
+    The window is presented with a loading state; the API connection is
+    opened once it is mapped. Devices live in a Gio.ListStore of
+    DeviceItem shown by a Gtk.ListView, so only visible rows are realized;
+    a new device list updates existing items in place and replaces only
+    the changed range of the store in one splice. While open the window
+    follows the notification stream and patches single rows from hotplug
+    events; the full list is fetched again only after a reconnect or when
+    an event cannot be applied. The auto-routing rules (see routing.py)
+    are listed and edited below the devices. Startup milestones ("map",
+    "first-paint", "devices-loaded", "devices-painted") are recorded in
+    ``timings`` as seconds since construction, logged at debug level and
+    passed to ``on_timing(name, seconds)`` when set.
+    """
+
+    def __init__(self, port, on_timing=None, **kwargs):
+        self._created = time.perf_counter()
+        self.timings = {}
+        self.on_timing = on_timing
         super().__init__(**kwargs)
-        self.apiclient = APIClient(port=port)
-        self.apiclient.connect()
+        self.apiclient = AsyncAPIClient(port=port)
+        self.apiclient.on_state = self._on_connection_state
+        self.notifications = None
+        self.port = port
         self.set_title("USB Devices")
         self.set_default_size(700, 520)
         self._active_popover = None
+        self._reconnecting = False
+        self._items = {}
+        self._row_widgets = {}
 
         root = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=16)
         root.set_margin_top(20); root.set_margin_bottom(20)
@@ -76,26 +152,146 @@ class DeviceSettings(Gtk.ApplicationWindow):
         section_lbl.set_xalign(0.0)
         root.append(section_lbl)
 
-        self.list = Gtk.ListBox()
+        bulk = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=8)
+        self.bulk_vms = Gtk.StringList()
+        self.bulk_target = Gtk.DropDown(model=self.bulk_vms)
+        bulk.append(self.bulk_target)
+        self.move_all_btn = Gtk.Button(label="Move all")
+        self.move_all_btn.connect("clicked", self._on_move_all)
+        bulk.append(self.move_all_btn)
+        eject_all_btn = Gtk.Button(label="Eject all")
+        eject_all_btn.connect("clicked", lambda *_: self.move_all(EJECT))
+        bulk.append(eject_all_btn)
+        root.append(bulk)
+
+        self.store = Gio.ListStore(item_type=DeviceItem)
+        factory = Gtk.SignalListItemFactory()
+        factory.connect("setup", self._on_row_setup)
+        factory.connect("bind", self._on_row_bind)
+        factory.connect("unbind", self._on_row_unbind)
+        self.list = Gtk.ListView(model=Gtk.SingleSelection(model=self.store), factory=factory)
         self.list.add_css_class("boxed-list")
-        self.list.set_selection_mode(Gtk.SelectionMode.SINGLE)
-        self.list.set_activate_on_single_click(True)
-        self.list.connect("row-activated", self._on_row_activated)
-        root.append(self.list)
-
+        self.list.set_single_click_activate(True)
+        self.list.connect("activate", self._on_row_activated)
+        scroller = Gtk.ScrolledWindow()
+        scroller.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        scroller.set_vexpand(True)
+        scroller.set_child(self.list)
+        root.append(scroller)
+
+        self.rules = load_rules()
+        root.append(self._build_rules_section())
+
+        status_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=8)
+        self.spinner = Gtk.Spinner()
+        status_box.append(self.spinner)
         self.status = Gtk.Label()
         self.status.set_xalign(0.0)
         self.status.add_css_class("dim-label")
-        root.append(self.status)
+        status_box.append(self.status)
+        root.append(status_box)
 
-        self._model = {}
-        self.refresh()
+        self._store = DeviceStore()
+        self._model = self._store.devices
+        self.refresher = RefreshScheduler(self.apiclient.usb_list, self._on_devices, 0)
+        self._set_loading("Loading devices...")
+        self.connect("map", self._on_map)
+        self.connect("close-request", self._on_close_request)
 
         kc = Gtk.EventControllerKey()
         kc.set_propagation_phase(Gtk.PropagationPhase.CAPTURE)
         kc.connect("key-pressed", self._on_window_key)
         self.add_controller(kc)
 
+    def _build_rules_section(self):
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=8)
+        label = Gtk.Label(label="Automatic Routing")
+        label.add_css_class("title-3")
+        label.set_xalign(0.0)
+        box.append(label)
+
+        self.rules_list = Gtk.ListBox()
+        self.rules_list.add_css_class("boxed-list")
+        self.rules_list.set_selection_mode(Gtk.SelectionMode.NONE)
+        box.append(self.rules_list)
+        self._render_rules()
+
+        form = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=8)
+        self.rule_field = Gtk.DropDown(model=Gtk.StringList.new([FIELD_LABELS[f] for f in FIELDS]))
+        self.rule_field.set_selected(FIELDS.index("vid_pid"))
+        form.append(self.rule_field)
+        self.rule_pattern = Gtk.Entry(placeholder_text="e.g. 1050:* or *Headset*")
+        self.rule_pattern.set_hexpand(True)
+        self.rule_pattern.connect("activate", self._on_add_rule)
+        form.append(self.rule_pattern)
+        self.rule_vm = Gtk.DropDown(model=self.bulk_vms)
+        form.append(self.rule_vm)
+        self.rule_priority = Gtk.SpinButton.new_with_range(-100, 100, 1)
+        self.rule_priority.set_tooltip_text("Priority: the highest matching rule wins")
+        form.append(self.rule_priority)
+        add_btn = Gtk.Button(label="Add rule")
+        add_btn.connect("clicked", self._on_add_rule)
+        form.append(add_btn)
+        box.append(form)
+        return box
+
+    def _render_rules(self):
+        while (row := self.rules_list.get_row_at_index(0)) is not None:
+            self.rules_list.remove(row)
+        if not self.rules:
+            empty = Gtk.Label(label="No rules: new devices always ask for a VM")
+            empty.add_css_class("dim-label")
+            empty.set_margin_top(10); empty.set_margin_bottom(10)
+            self.rules_list.append(empty)
+            return
+        for rule in self.rules:
+            h = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=12)
+            h.set_margin_top(8); h.set_margin_bottom(8)
+            h.set_margin_start(16); h.set_margin_end(8)
+            match = Gtk.Label(label=rule.describe())
+            match.set_xalign(0.0)
+            match.set_hexpand(True)
+            match.set_ellipsize(Pango.EllipsizeMode.END)
+            h.append(match)
+            target = Gtk.Label(label=f"{rule.vm} (priority {rule.priority})")
+            target.add_css_class("dim-label")
+            h.append(target)
+            remove = Gtk.Button.new_from_icon_name("user-trash-symbolic")
+            remove.set_tooltip_text("Remove rule")
+            remove.connect("clicked", lambda _btn, r=rule: self._set_rules(
+                [other for other in self.rules if other is not r]
+            ))
+            h.append(remove)
+            self.rules_list.append(h)
+
+    def _set_rules(self, rules):
+        try:
+            save_rules(rules)
+        except OSError as e:
+            self._notify_error("Failed to save rules", str(e))
+            return
+        self.rules = rules
+        self._render_rules()
+
+    def _on_add_rule(self, *_):
+        vm = self.rule_vm.get_selected_item()
+        pattern = self.rule_pattern.get_text().strip()
+        if vm is None or not pattern:
+            return
+        field = FIELDS[self.rule_field.get_selected()]
+        try:
+            rule = Rule(vm.get_string(), self.rule_priority.get_value_as_int(), **{field: pattern})
+        except ValueError as e:
+            self._notify_error("Invalid rule", str(e))
+            return
+        self.rule_pattern.set_text("")
+        self._set_rules(add_rule(self.rules, rule))
+
+    def _remember_route(self, device, vm):
+        if vm == EJECT:
+            return
+        self._set_rules(add_rule(self.rules, rule_for_device(device, vm)))
+
     def _notify_error(self, title: str, msg: str) -> None:
         dlg = Gtk.AlertDialog()
         dlg.set_message(title)
@@ -103,33 +299,167 @@ class DeviceSettings(Gtk.ApplicationWindow):
         dlg.set_modal(True)
         dlg.show(self)
         
+    def _mark(self, name):
+        elapsed = time.perf_counter() - self._created
+        self.timings.setdefault(name, elapsed)
+        logger.debug("Settings %s after %.1f ms", name, elapsed * 1000)
+        if self.on_timing is not None:
+            self.on_timing(name, elapsed)
+
+    def _mark_after_paint(self, name):
+        clock = self.get_frame_clock()
+        if clock is None:
+            self._mark(name)
+            return
+
+        def _painted(_clock):
+            clock.disconnect(handler)
+            self._mark(name)
+
+        handler = clock.connect("after-paint", _painted)
+        self.queue_draw()
+
+    def _on_map(self, *_):
+        self._mark("map")
+        self._mark_after_paint("first-paint")
+        # Connect only after the loading state has been painted.
+        GLib.idle_add(self._start_loading)
+
+    def _start_loading(self):
+        self.apiclient.start()
+        self.refresh()
+        self.notifications = AsyncAPIClient.recv_notifications(
+            self._on_device_event, port=self.port, on_connected=self._on_notifications_connected,
+        )
+        return GLib.SOURCE_REMOVE
+
+    def _on_close_request(self, *_):
+        self.refresher.cancel()
+        if self.notifications is not None:
+            self.notifications.close()
+        self.apiclient.close()
+        return False
+
+    def _on_notifications_connected(self):
+        # Events sent before the subscription took effect were missed.
+        self._store.invalidate()
+        self.refresh()
+
+    @log_entry_exit
+    def _on_device_event(self, msg):
+        if self._store.apply_event(msg):
+            self.refresher.mark_stale()
+            self._sync_store()
+            self._update_bulk_targets()
+            self.status.set_text("" if len(self._model) else "No USB devices")
+        else:
+            self.refresh()
+
+    def _set_loading(self, text):
+        self.status.set_text(text)
+        if text:
+            self.spinner.start()
+        else:
+            self.spinner.stop()
+        self.spinner.set_visible(bool(text))
+
+    def _on_connection_state(self, state):
+        if state == RECONNECTING:
+            self._reconnecting = True
+            self._set_loading("Reconnecting to USB service...")
+        elif state == CONNECTED and self._reconnecting:
+            self._reconnecting = False
+            self.refresh()
+
     def refresh(self):
-        try:
-            self._model = self.apiclient.get_devices_pretty()
-            logger.info(json.dumps(self._model, indent=4, sort_keys=True))
-        except Exception as e:
-            logger.exception("Failed fetching devices")
-            GLib.idle_add(self._notify_error, "Device Error", f"Message: {e}")
+        self.refresher.request()
+
+    @log_entry_exit
+    def _on_devices(self, response, error):
+        if error is not None:
+            logger.error("Failed fetching devices: %s", error)
+            self._set_loading("")
+            self._notify_error("Device Error", f"Message: {error}")
+            return
+        if not self._store.replace(response):
+            self._set_loading("")
+            self._notify_error("Device Error", f"Message: {response.get('error', response)}")
+            return
+        self._mark("devices-loaded")
+        logger.debug("Device model: %s", Lazy(_model_dump, list(self._model.items())))
+        self._sync_store()
+        self._update_bulk_targets()
+        self._set_loading("")
+        if not len(self._model):
+            self.status.set_text("No USB devices")
+        self._mark_after_paint("devices-painted")
+
+    @log_entry_exit
+    def _sync_store(self):
+        items = {}
+        ordered = []
+        for name, dev in self._model.items():
+            item = self._items.get(dev.device_node)
+            if item is None:
+                item = DeviceItem(name, dev)
+            else:
+                item.update(name, dev)
+            items[dev.device_node] = item
+            ordered.append(item)
+        self._items = items
+
+        # Replace only the range that differs, in a single items-changed.
+        old = [self.store.get_item(i) for i in range(self.store.get_n_items())]
+        start = 0
+        while start < min(len(old), len(ordered)) and old[start] is ordered[start]:
+            start += 1
+        end_old, end_new = len(old), len(ordered)
+        while end_old > start and end_new > start and old[end_old - 1] is ordered[end_new - 1]:
+            end_old -= 1
+            end_new -= 1
+        if end_old > start or end_new > start:
+            self.store.splice(start, end_old - start, ordered[start:end_new])
+
+    def _update_bulk_targets(self):
+        vms = []
+        for dev in self._model:
+            vms.extend(vm for vm in dev.allowed_vms if vm != EJECT and vm not in vms)
+        current = [self.bulk_vms.get_string(i) for i in range(self.bulk_vms.get_n_items())]
+        if vms != current:
+            self.bulk_vms.splice(0, len(current), vms)
+        self.move_all_btn.set_sensitive(bool(vms))
+
+    def _on_move_all(self, *_):
+        item = self.bulk_target.get_selected_item()
+        if item is not None:
+            self.move_all(item.get_string())
+
+    @log_entry_exit
+    def move_all(self, vm):
+        assignments = [
+            (dev.device_node, vm) for dev in self._model
+            if vm in dev.allowed_vms and dev.vm != vm
+        ]
+        if not assignments:
             return
-        self._rebuild_rows()
 
-    def _rebuild_rows(self):
-        for ch in list(self.list):
-            self.list.remove(ch)
-        for key, data in self._model.items():
-            self.list.append(self._build_row(key, data))
-        self.list.show()
+        def _done(results, error):
+            if error is not None:
+                self._notify_error("Failed to move devices", f"{error}")
+            else:
+                failed = [f"{node}: {res.get('error', 'Unknown error!')}"
+                          for node, _vm, res in results if not is_success(res)]
+                if failed:
+                    self._notify_error("Failed to move devices", "\n".join(failed))
 
-    def _build_row(self, l1_key, data):
-        row = Gtk.ListBoxRow()
-        row._l1_key = l1_key
-        row.set_activatable(True)
+        self.apiclient.usb_attach_many(assignments, _done)
 
+    def _on_row_setup(self, _factory, list_item):
         h = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=12)
         h.set_margin_top(14); h.set_margin_bottom(14)
         h.set_margin_start(16); h.set_margin_end(16)
 
-        title = Gtk.Label(label=l1_key)
+        title = Gtk.Label()
         title.set_xalign(0.0)
         title.set_hexpand(True)
         title.set_ellipsize(Pango.EllipsizeMode.END)
@@ -138,19 +468,41 @@ class DeviceSettings(Gtk.ApplicationWindow):
 
         right = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
         right.set_halign(Gtk.Align.END)
-        value = Gtk.Label(label=str(data.get("vm")))
+        value = Gtk.Label()
         value.add_css_class("dim-label")
         right.append(value)
         chevron = Gtk.Image.new_from_icon_name("pan-down-symbolic")
         right.append(chevron)
-        row._value_label = value
 
         h.append(right)
-        row.set_child(h)
-        return row
+        h._title_label = title
+        h._value_label = value
+        h._bindings = ()
+        list_item.set_child(h)
+
+    @log_entry_exit
+    def _on_row_bind(self, _factory, list_item):
+        h = list_item.get_child()
+        item = list_item.get_item()
+        flags = GObject.BindingFlags.SYNC_CREATE
+        h._bindings = (
+            item.bind_property("name", h._title_label, "label", flags),
+            item.bind_property("vm", h._value_label, "label", flags),
+        )
+        self._row_widgets[item] = h
+
+    def _on_row_unbind(self, _factory, list_item):
+        h = list_item.get_child()
+        for binding in h._bindings:
+            binding.unbind()
+        h._bindings = ()
+        item = list_item.get_item()
+        if self._row_widgets.get(item) is h:
+            del self._row_widgets[item]
+            if self._active_popover is not None and self._active_popover.get_parent() is h:
+                self._active_popover.popdown()
 
-    def _open_popover_for_row(self, row):
-        self.list.select_row(row)
+    def _open_popover_for_item(self, item, widget):
         if self._active_popover:
             try:
                 self._active_popover.popdown()
@@ -158,54 +510,62 @@ class DeviceSettings(Gtk.ApplicationWindow):
                 pass
             self._active_popover = None
 
-        key = getattr(row, "_l1_key", None)
-        if not key:
-            return
-        entry = self._model.get(key, {})
-        options = entry.get("allowed_vms", [])
-        selected = entry.get("vm")
-
+        entry = item.device
         pop = OptionsPopover(
-            parent_widget=row,
-            title=key,
-            options=options,
-            selected=selected,
-            on_chosen=lambda opt, k=key, r=row: self._apply_choice(k, opt, r),
+            parent_widget=widget,
+            title=item.name,
+            options=entry.allowed_vms,
+            selected=entry.vm,
+            on_chosen=lambda opt, remember, it=item: self._apply_choice(it, opt, remember),
         )
         pop.connect("closed", self._on_popover_closed)
 
         self._active_popover = pop
         pop.popup()
 
-    def _on_popover_closed(self, *_):
-        self._active_popover = None
+    def _on_popover_closed(self, pop):
+        if self._active_popover is pop:
+            self._active_popover = None
+        GLib.idle_add(pop.unparent)
         self.list.grab_focus()
 
-    def _on_row_activated(self, _lb, row):
-        if row:
-            self._open_popover_for_row(row)
-
-    def _attach_to(self, device_name: str, new_vm: str):
-        device = self._model.get(device_name, {})
-        device_id = device.get("device_node", "")
-
-        if new_vm.lower() != device.get("vm", ""):
-            rsp = self.apiclient.usb_attach(device_id, new_vm)
-            if rsp.get("event") == "usb_attached" or rsp.get("result") == "ok":
-                device["vm"] = new_vm
-                return True
-            GLib.idle_add(self._notify_error, "Failed to attach", f"{rsp.get('error', 'Unknown error!')}")
-            return False
-        return True
-    
-    def _apply_choice(self, l1_key, opt, row):
-        cur = self._model.get(l1_key, {}).get("vm")
-        if opt == cur:
+    def _on_row_activated(self, _view, position):
+        item = self.store.get_item(position)
+        widget = self._row_widgets.get(item)
+        if item is not None and widget is not None:
+            self._open_popover_for_item(item, widget)
+
+    def _attach_to(self, item, new_vm: str):
+        device = item.device
+        if new_vm == device.vm:
+            return
+
+        moved = device.with_vm(new_vm)
+
+        def _done(rsp, error):
+            if error is None and is_success(rsp):
+                return
+            detail = error if error is not None else rsp.get('error', 'Unknown error!')
+            self._notify_error("Failed to attach", f"{detail}")
+            # Only undo our own optimistic update; an event applied since
+            # (or the device going away) is newer than ``device``.
+            if self._model.get(device.device_node) is moved:
+                self._model.upsert(device)
+                item.update(item.name, device)
+
+        self._model.upsert(moved)
+        item.update(item.name, moved)
+        if new_vm == EJECT:
+            self.apiclient.usb_detach(device.device_node, _done)
+        else:
+            self.apiclient.usb_attach(device.device_node, new_vm, _done)
+
+    def _apply_choice(self, item, opt, remember=False):
+        if remember:
+            self._remember_route(item.device, opt)
+        if opt == item.device.vm:
             return
-        self._attach_to(l1_key, opt)
-        self._model[l1_key]["vm"] = opt
-        if hasattr(row, "_value_label"):
-            row._value_label.set_text(str(opt))
+        self._attach_to(item, opt)
 
     def _on_window_key(self, _ctl, keyval, *_):
         if keyval == Gdk.KEY_Escape:
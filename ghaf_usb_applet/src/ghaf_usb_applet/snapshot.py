@@ -0,0 +1,59 @@
+# Copyright 2022-2025 TII (SSRC) and the Ghaf contributors
+# SPDX-License-Identifier: Apache-2.0
+
+# Last known device list, kept under $XDG_CACHE_HOME so the tray can show
+# a menu right after login, before the first usb_list reply. The file is
+# replaced atomically and carries a format version; anything unreadable or
+# from another version is ignored.
+
+import json
+import os
+import time
+
+from ghaf_usb_applet.devices import USBDevice
+from ghaf_usb_applet.logger import logger
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILE = "devices.json"
+
+
+def snapshot_path():
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_dir, "ghaf-usb-applet", SNAPSHOT_FILE)
+
+
+def save_snapshot(devices, path=None):
+    path = path or snapshot_path()
+    data = {
+        "version": SNAPSHOT_VERSION,
+        "saved": time.time(),
+        "devices": [dev.to_dict() for dev in devices],
+    }
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, path)
+    logger.debug("Saved device snapshot of %d devices to %s", len(data["devices"]), path)
+
+
+def load_snapshot(path=None):
+    """Devices from the snapshot at ``path``, or None if there is no usable one."""
+    path = path or snapshot_path()
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable device snapshot %s: %s", path, e)
+        return None
+    if not isinstance(data, dict) or data.get("version") != SNAPSHOT_VERSION:
+        logger.info("Ignoring device snapshot %s with another format version", path)
+        return None
+    devices = []
+    for dev in data.get("devices") or []:
+        device = USBDevice.from_wire(dev) if isinstance(dev, dict) else None
+        if device is not None:
+            devices.append(device)
+    return devices
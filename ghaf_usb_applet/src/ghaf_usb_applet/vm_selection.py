@@ -4,40 +4,34 @@
 import gi
 gi.require_version("Gtk", "4.0")
 gi.require_version("Gdk", "4.0")
-from gi.repository import Gtk, Gio, Gdk
+from gi.repository import Gtk, Gio, Gdk, GLib
 
-from ghaf_usb_applet.logger import logger
+from ghaf_usb_applet.logger import log_entry_exit, logger
 from ghaf_usb_applet.api_client import APIClient
+from ghaf_usb_applet.async_client import AsyncAPIClient
+from ghaf_usb_applet.chooser import bind_chooser_socket, decode_request
+from ghaf_usb_applet.framing import FrameDecoder, FrameTooLarge
 
 SELECT = "Select"
 
-class DeviceSetting(Gtk.Application):
-    def __init__(self, device: dict, apiclient: APIClient, title: str, app_id="ghaf.usb.setting"):
-        super().__init__(application_id=app_id, flags=Gio.ApplicationFlags.FLAGS_NONE)
+class DeviceSettingWindow(Gtk.ApplicationWindow):
+    def __init__(self, application, device: dict, apiclient: APIClient, title: str):
+        super().__init__(application=application, title=title)
         self.device = device or {}
         self.apiclient = apiclient
-        self.win = None
-        self.title = title
-
-    def do_activate(self):
-        if self.win:
-            self.win.present()
-            return
-
-        self.win = Gtk.ApplicationWindow(application=self, title=self.title)
-        self.win.set_resizable(False)
-        self.win.set_default_size(360, 160)
+        self.set_resizable(False)
+        self.set_default_size(360, 160)
 
         key = Gtk.EventControllerKey()
         key.connect("key-pressed", self._on_key_pressed)
-        self.win.add_controller(key)
+        self.add_controller(key)
 
         outer = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
         outer.set_margin_top(12)
         outer.set_margin_bottom(12)
         outer.set_margin_start(12)
         outer.set_margin_end(12)
-        self.win.set_child(outer)
+        self.set_child(outer)
 
         product = self.device.get("product_name") or "USB Device"
         lbl_title = Gtk.Label(xalign=0)
@@ -79,10 +73,11 @@ class DeviceSetting(Gtk.Application):
         outer.append(actions)
 
         btn_close = Gtk.Button(label="Close")
-        btn_close.connect("clicked", lambda *_: self.win.close())
+        btn_close.connect("clicked", lambda *_: self.close())
         actions.append(btn_close)
-        self.win.present()
+        self.connect("map", lambda *_: logger.debug("Device chooser shown: %s", title))
 
+    @log_entry_exit
     def _on_selected(self, dropdown: Gtk.DropDown, _pspec, device_id: str, allowed: list):
         idx = dropdown.get_selected()
         choice = dropdown.get_model().get_string(idx)
@@ -91,29 +86,31 @@ class DeviceSetting(Gtk.Application):
             return
         
         if choice not in allowed:
-            logger.error(f"Invalid choice, Selected:{choice} Allowed:{allowed}")
+            logger.error("Invalid choice, Selected:%s Allowed:%s", choice, allowed)
             return
 
         if choice == self.device.get("vm"):
-            logger.info(f"Device already passed to the VM:{choice}")
+            logger.info("Device already passed to the VM:%s", choice)
             return
             
         if device_id:
-            logger.info(f"Device PASS req to the VM:{choice} for device: {device_id}")
-            res = self.apiclient.usb_attach(device_id, choice)
-            logger.info(f"Device PASS respooce:{res}")
-            if (
-                res.get('event', '') == 'usb_attached'
-                or res.get('result', '') == 'ok'
-            ):
-                dropdown.set_selected(idx)
-                self.device["vm"] = choice
-            else:
-                GLib.idle_add(self._notify_error, "Device Error", "Message: {res}")
-                
+            logger.info("Device PASS req to the VM:%s for device: %s", choice, device_id)
+
+            def _done(res, error):
+                logger.debug("Device PASS response:%s", res)
+                if error is None and (
+                    res.get('event', '') == 'usb_attached'
+                    or res.get('result', '') == 'ok'
+                ):
+                    self.device["vm"] = choice
+                else:
+                    self._notify_error("Device Error", f"Message: {error or res}")
+
+            self.apiclient.usb_attach(device_id, choice, _done)
+
     def _on_key_pressed(self, _ctrl, keyval, _keycode, _state):
         if keyval == Gdk.KEY_Escape:
-            self.win.close()
+            self.close()
             return True
         return False
 
@@ -124,12 +121,100 @@ class DeviceSetting(Gtk.Application):
         dlg.set_modal(True)
         dlg.show(self)
 
+
+class DeviceSetting(Gtk.Application):
+    def __init__(self, device: dict, apiclient: APIClient, title: str, app_id="ghaf.usb.setting"):
+        super().__init__(application_id=app_id, flags=Gio.ApplicationFlags.FLAGS_NONE)
+        self.device = device or {}
+        self.apiclient = apiclient
+        self.win = None
+        self.title = title
+
+    def do_activate(self):
+        if self.win:
+            self.win.present()
+            return
+        self.win = DeviceSettingWindow(self, self.device, self.apiclient, self.title)
+        self.win.present()
+
+
+class DeviceChooserService(Gtk.Application):
+    def __init__(self, apiclient: APIClient, app_id="ghaf.usb.chooser"):
+        super().__init__(application_id=app_id, flags=Gio.ApplicationFlags.FLAGS_NONE)
+        self.apiclient = apiclient
+        self.windows = {}
+        self._server = None
+
+    def do_activate(self):
+        if self._server is not None:
+            return
+        try:
+            self._server = bind_chooser_socket()
+        except (OSError, RuntimeError) as e:
+            logger.error("Device chooser service not started: %s", e)
+            return
+        self.hold()
+        GLib.io_add_watch(
+            self._server.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._on_incoming
+        )
+        logger.info("Device chooser service ready")
+
+    def _on_incoming(self, *_):
+        try:
+            conn, _addr = self._server.accept()
+        except OSError as e:
+            logger.warning("Device chooser accept failed: %s", e)
+            return GLib.SOURCE_CONTINUE
+        GLib.io_add_watch(
+            conn.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self._on_request, conn, FrameDecoder(max_frame=65536),
+        )
+        return GLib.SOURCE_CONTINUE
+
+    @log_entry_exit
+    def _on_request(self, _fd, condition, conn, decoder):
+        try:
+            received = decoder.recv_into(conn) if condition & GLib.IO_IN else 0
+            frames = list(decoder.frames())
+        except (OSError, FrameTooLarge) as e:
+            logger.warning("Device chooser connection error: %s", e)
+            received = 0
+        if not received:
+            conn.close()
+            return GLib.SOURCE_REMOVE
+        for line in frames:
+            try:
+                request = decode_request(line)
+            except ValueError:
+                logger.error("Invalid device chooser request: %s", line)
+                continue
+            self.show(request["device"], request.get("title", "USB Device"))
+        return GLib.SOURCE_CONTINUE
+
+    @log_entry_exit
+    def show(self, device: dict, title: str):
+        node = device.get("device_node", "")
+        win = self.windows.get(node)
+        if win is None:
+            win = DeviceSettingWindow(self, device, self.apiclient, title)
+            win.connect("close-request", self._on_window_closed, node)
+            self.windows[node] = win
+        win.present()
+
+    def _on_window_closed(self, _win, node):
+        self.windows.pop(node, None)
+        return False
+
 def show_device_setting(device: dict, title: str, apiclient: APIClient = None, port: int = 2000):
     client = apiclient
     if apiclient is None:
-        client = APIClient(port=port)
-        client.connect()
+        client = AsyncAPIClient(port=port)
+        client.start()
     app = DeviceSetting(device=device, apiclient=client, title = title)
     raise SystemExit(app.run(None))
 
-
+def serve_device_chooser(port: int = 2000):
+    client = AsyncAPIClient(port=port)
+    client.start()
+    app = DeviceChooserService(apiclient=client)
+    raise SystemExit(app.run(None))